@@ -1,12 +1,30 @@
+import time
 import os
+import io
+import re
+import csv
+import gzip
 import json
+import asyncio
+import ipaddress
 import sqlite3
 import random
+import hashlib
+import hmac
+import base64
+import socket
 import string
-from datetime import datetime, timezone
+import struct
+import tempfile
+import uuid
+import signal
+import logging
+import threading
+import contextlib
+from collections import OrderedDict, deque
+from datetime import datetime, timezone, timedelta, time as dtime
 from typing import Optional, List, Tuple
 
-import requests
 from dotenv import load_dotenv
 
 from telegram import (
@@ -15,15 +33,23 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import NetworkError, BadRequest, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     ContextTypes,
     filters,
 )
 
+log = logging.getLogger("bot")
+# startup clock; the imports above are cheap next to the phases it times (DB, app build)
+STARTED = time.perf_counter()
+
 # ================== Config ==================
 load_dotenv()
 
@@ -31,256 +57,654 @@ TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
 CF_API_TOKEN = os.getenv("CF_API_TOKEN")
 CF_ZONE_ID = os.getenv("CF_ZONE_ID")
 CF_BASE_DOMAIN = os.getenv("CF_BASE_DOMAIN")
+# extra zones for new domains: "zone_id:base_domain[:api_token],..." (token defaults to CF_API_TOKEN)
+CF_ZONES = os.getenv("CF_ZONES", "")
+# how new domains are spread over the zones: least_loaded | round_robin
+ZONE_POLICY = os.getenv("ZONE_POLICY", "least_loaded")
+# comment put on every record the bot creates; the reaper only ever touches records carrying it
+CF_RECORD_COMMENT = os.getenv("CF_RECORD_COMMENT", "dns-bot")
 
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "5"))
 DB_PATH = os.getenv("DB_PATH", "database/bot.db")
 
+# authoritative nameservers checked after provisioning ("host" or "host:port"); empty = no check
+NS1 = os.getenv("NS1", "")
+NS2 = os.getenv("NS2", "")
+# the same for the CF_ZONES domains: "domain=ns[|ns],..."; zones without any are not checked
+CF_ZONE_NS = os.getenv("CF_ZONE_NS", "")
+DNS_VERIFY_TIMEOUT = float(os.getenv("DNS_VERIFY_TIMEOUT", "180"))
+DNS_QUERY_TIMEOUT = float(os.getenv("DNS_QUERY_TIMEOUT", "2"))
+DNS_CONCURRENCY = int(os.getenv("DNS_CONCURRENCY", "20"))
+
 WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL") or "").rstrip("/")
 PORT = int(os.getenv("PORT", "8080"))
+# embedded webhook server: Telegram posts to WEBHOOK_BASE_URL + WEBHOOK_PATH with WEBHOOK_SECRET
+# in X-Telegram-Bot-Api-Secret-Token; /healthz, /readyz and /metrics are served on the same port
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "webhook").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or hashlib.sha256(f"webhook:{os.getenv('TG_BOT_TOKEN')}".encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONN = int(os.getenv("WEBHOOK_MAX_CONN", "40"))
+# updates handled in parallel; opt-in, since handlers share one SQLite connection.
+# Above 1, same-user updates are serialized by the per-user lock (busy ones are refused)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "1"))
+# seconds to finish queued updates and background tasks on SIGTERM
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+
+# opt-in traffic recorder (updates + Cloudflare/Telegram call timings) for replay.py; empty = off
+RECORD_DIR = os.getenv("RECORD_DIR", "")
+RECORD_MAX_MB = int(os.getenv("RECORD_MAX_MB", "64"))
+RECORD_KEEP = int(os.getenv("RECORD_KEEP", "14"))
+
+# background reaper (orphaned / expired DNS records); interval 0 disables it
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", "3600"))
+REAPER_BATCH = int(os.getenv("REAPER_BATCH", "50"))
+REAPER_DELAY = float(os.getenv("REAPER_DELAY", "0.5"))
+REAPER_GRACE = int(os.getenv("REAPER_GRACE", "3600"))
+DOMAIN_MAX_AGE_DAYS = int(os.getenv("DOMAIN_MAX_AGE_DAYS", "0"))
+
+# scheduled maintenance: online backup, ANALYZE, incremental vacuum; interval 0 disables it
+MAINT_INTERVAL = int(os.getenv("MAINT_INTERVAL", "86400"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", "") or os.path.join(os.path.dirname(DB_PATH) or ".", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "500"))
+# days of per-user quota history (quota_daily) kept by the maintenance job; 0 = keep all
+QUOTA_HISTORY_DAYS = int(os.getenv("QUOTA_HISTORY_DAYS", "90"))
+
+# admin bulk provisioning
+BULK_MAX = int(os.getenv("BULK_MAX", "500"))
+BULK_CHUNK = int(os.getenv("BULK_CHUNK", "50"))
+BULK_DELAY = float(os.getenv("BULK_DELAY", "1.0"))
+
+# per-user flood control: token bucket (rate per second, burst) and duplicate-tap window
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "5"))
+CALLBACK_DEBOUNCE = float(os.getenv("CALLBACK_DEBOUNCE", "2"))
+
+# more than REF_BURST_MAX referrals by one user within REF_BURST_WINDOW seconds are recorded
+# but not rewarded, and the admin is told
+REF_BURST_MAX = int(os.getenv("REF_BURST_MAX", "10"))
+REF_BURST_WINDOW = int(os.getenv("REF_BURST_WINDOW", "3600"))
+
+# admin notifications are coalesced into a digest every N seconds; 0 = send each event
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", "300"))
+
+# key for the integrity tag on domain callback buttons (defaults to the bot token)
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET", "")
+
+# accept RFC1918 / CGNAT / ULA targets (loopback, multicast and reserved are always refused)
+ALLOW_PRIVATE_IPS = os.getenv("ALLOW_PRIVATE_IPS", "0") == "1"
+
+# shared state (conversation state, locks, cache versions); empty = in-process only
+STATE_URL = os.getenv("STATE_URL", "")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "domen:")
+STATE_TTL = int(os.getenv("STATE_TTL", "86400"))
+STATE_LOCK_TTL = float(os.getenv("STATE_LOCK_TTL", "60"))
+STATE_LOCK_WAIT = float(os.getenv("STATE_LOCK_WAIT", "10"))
+
+# single-process conversation state: SQLite table + LRU working set, flushed write-behind
+CONV_CACHE_SIZE = int(os.getenv("CONV_CACHE_SIZE", "10000"))
+CONV_FLUSH_INTERVAL = float(os.getenv("CONV_FLUSH_INTERVAL", "5"))
+
+# circuit breakers around Cloudflare and get_chat_member: trip when, over the last
+# BREAKER_WINDOW seconds, at least BREAKER_MIN_CALLS calls were made and BREAKER_ERROR_RATE
+# of them failed or took longer than BREAKER_SLOW_CALL seconds; probe again after BREAKER_COOLDOWN
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", "8"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+# let users through the forced-subscription check while Telegram is failing (default: block)
+SUB_FAIL_OPEN = os.getenv("SUB_FAIL_OPEN", "0") == "1"
 
 CF_API = "https://api.cloudflare.com/client/v4"
+CF_LIST_PAGE = 5000  # records per page for full-zone listings (reaper, /bulk)
+
+@contextlib.contextmanager
+def startup_phase(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        log.info("startup: %s took %.1f ms", name, (time.perf_counter() - t0) * 1000)
+
 
-missing = [k for k, v in {
-    "TG_BOT_TOKEN": TG_BOT_TOKEN,
-    "CF_API_TOKEN": CF_API_TOKEN,
-    "CF_ZONE_ID": CF_ZONE_ID,
-    "CF_BASE_DOMAIN": CF_BASE_DOMAIN,
-}.items() if not v]
-if missing:
-    raise RuntimeError("❌ Missing env vars: " + ", ".join(missing))
+def check_config() -> None:
+    missing = [k for k, v in {
+        "TG_BOT_TOKEN": TG_BOT_TOKEN,
+        "CF_API_TOKEN": CF_API_TOKEN,
+        "CF_ZONE_ID": CF_ZONE_ID,
+        "CF_BASE_DOMAIN": CF_BASE_DOMAIN,
+    }.items() if not v]
+    if missing:
+        raise RuntimeError("❌ Missing env vars: " + ", ".join(missing))
+    if ZONE_POLICY not in ("least_loaded", "round_robin"):
+        raise RuntimeError(f"❌ Bad ZONE_POLICY: {ZONE_POLICY}")
+    load_zones()
 
-os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
 
 # ================== DB ==================
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS quota (
-    user_id INTEGER PRIMARY KEY,
-    used INTEGER DEFAULT 0,
-    bonus INTEGER DEFAULT 0,
-    last_date TEXT
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS domains (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    subdomain TEXT,
-    ip TEXT,
-    created_at TEXT
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    first_name TEXT,
-    username TEXT,
-    joined_at TEXT,
-    banned INTEGER DEFAULT 0,
-    referred_by INTEGER,
-    ref_rewarded INTEGER DEFAULT 0,
-    lang TEXT
-)
-""")
+# Opened lazily by init_db() from the application's post_init hook.
+# Bump SCHEMA_VERSION whenever migrate_db() changes; an up-to-date file skips it.
+SCHEMA_VERSION = 8
+
+conn: Optional[sqlite3.Connection] = None
+cur: Optional[sqlite3.Cursor] = None
+
+
+def connect_db(path: str = DB_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    c = sqlite3.connect(path, check_same_thread=False, timeout=15)
+    # WAL lets several bot processes share the file without readers blocking writers
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    return c
+
+
+def migrate_db(c: sqlite3.Connection) -> bool:
+    cur = c.cursor()
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] >= SCHEMA_VERSION:
+        return False
+
+    # takes effect on a fresh file; existing files are converted by "/maint vacuum"
+    cur.execute("SELECT COUNT(*) FROM sqlite_master")
+    fresh = cur.fetchone()[0] == 0
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS quota (
+        user_id INTEGER PRIMARY KEY,
+        used INTEGER DEFAULT 0,
+        bonus INTEGER DEFAULT 0,
+        last_date TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS domains (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        subdomain TEXT,
+        ip TEXT,
+        created_at TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_name TEXT,
+        username TEXT,
+        joined_at TEXT,
+        banned INTEGER DEFAULT 0,
+        referred_by INTEGER,
+        ref_rewarded INTEGER DEFAULT 0,
+        lang TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+    # defaults
+    cur.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?,?)", [
+        ("welcome_message_ar", "👋 مرحبًا بك\n\n✅ اضغط زر 🔗 ربط IP ثم أرسل IP فقط."),
+        ("welcome_message_en", "👋 Welcome\n\n✅ Tap 🔗 Link IP then send IP only."),
+        ("help_message_ar", "ℹ️ المساعدة\n\n1) اضغط 🔗 ربط IP\n2) أرسل IP فقط\n3) راح ينشئ دومين عشوائي + A + NS\n\n⏱️ الحد اليومي: 5"),
+        ("help_message_en", "ℹ️ Help\n\n1) Tap 🔗 Link IP\n2) Send IP only\n3) It will create random domain + A + NS\n\n⏱️ Daily limit: 5"),
+        ("bot_status", "on"),
+        ("force_channels", json.dumps(["@eshop_2"])),
+    ])
+
+    # migrations for columns added after the first release
+    cur.execute("PRAGMA table_info(domains)")
+    domain_cols = [r[1] for r in cur.fetchall()]
+    if "updated_at" not in domain_cols:
+        cur.execute("ALTER TABLE domains ADD COLUMN updated_at TEXT")
+    if "record_id" not in domain_cols:
+        cur.execute("ALTER TABLE domains ADD COLUMN record_id TEXT")
+    # Cloudflare zone id of the row; NULL = rows created before multi-zone (primary zone)
+    if "zone" not in domain_cols:
+        cur.execute("ALTER TABLE domains ADD COLUMN zone TEXT")
+
+    # indexes for admin listing / search (LIKE prefix lookups need NOCASE)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users(joined_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_first_name ON users(first_name COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_domains_subdomain ON domains(subdomain COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_domains_ip ON domains(ip COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_domains_user ON domains(user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_domains_activity ON domains(COALESCE(updated_at, created_at))")
+
+    # materialized counters (maintained by triggers, read by admin views)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        key TEXT PRIMARY KEY,
+        value INTEGER DEFAULT 0
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT PRIMARY KEY,
+        new_users INTEGER DEFAULT 0,
+        domains_created INTEGER DEFAULT 0,
+        domains_deleted INTEGER DEFAULT 0
+    )
+    """)
+
+    cur.executescript("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE stats_counters SET value=value+1 WHERE key='users_total';
+        UPDATE stats_counters SET value=value+NEW.banned WHERE key='users_banned';
+        INSERT OR IGNORE INTO stats_daily (day) VALUES (substr(NEW.joined_at, 1, 10));
+        UPDATE stats_daily SET new_users=new_users+1 WHERE day=substr(NEW.joined_at, 1, 10);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE stats_counters SET value=value-1 WHERE key='users_total';
+        UPDATE stats_counters SET value=value-OLD.banned WHERE key='users_banned';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_users_banned AFTER UPDATE OF banned ON users
+    WHEN NEW.banned IS NOT OLD.banned
+    BEGIN
+        UPDATE stats_counters SET value=value+(NEW.banned-OLD.banned) WHERE key='users_banned';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_domains_insert AFTER INSERT ON domains
+    BEGIN
+        UPDATE stats_counters SET value=value+1 WHERE key='domains_active';
+        INSERT OR IGNORE INTO stats_daily (day) VALUES (substr(NEW.created_at, 1, 10));
+        UPDATE stats_daily SET domains_created=domains_created+1 WHERE day=substr(NEW.created_at, 1, 10);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_domains_delete AFTER DELETE ON domains
+    BEGIN
+        UPDATE stats_counters SET value=value-1 WHERE key='domains_active';
+        INSERT OR IGNORE INTO stats_daily (day) VALUES (date('now'));
+        UPDATE stats_daily SET domains_deleted=domains_deleted+1 WHERE day=date('now');
+    END;
+    """)
+
+    # one-time backfill for databases created before the counters existed
+    cur.execute("SELECT COUNT(*) FROM stats_counters")
+    if cur.fetchone()[0] == 0:
+        cur.execute("INSERT INTO stats_counters (key, value) SELECT 'users_total', COUNT(*) FROM users")
+        cur.execute("INSERT INTO stats_counters (key, value) SELECT 'users_banned', COUNT(*) FROM users WHERE banned=1")
+        cur.execute("INSERT INTO stats_counters (key, value) SELECT 'domains_active', COUNT(*) FROM domains")
+        cur.execute("""
+        INSERT OR IGNORE INTO stats_daily (day, new_users)
+        SELECT substr(joined_at, 1, 10), COUNT(*) FROM users WHERE joined_at IS NOT NULL GROUP BY 1
+        """)
+        cur.execute("""
+        INSERT OR IGNORE INTO stats_daily (day) SELECT DISTINCT substr(created_at, 1, 10) FROM domains
+        WHERE created_at IS NOT NULL
+        """)
+        cur.execute("""
+        UPDATE stats_daily SET domains_created=(
+            SELECT COUNT(*) FROM domains WHERE substr(domains.created_at, 1, 10)=stats_daily.day
+        )
+        """)
+
+    # per-zone domain counts for least-loaded placement ('zone:' holds the NULL-zone rows)
+    cur.executescript("""
+    CREATE TRIGGER IF NOT EXISTS trg_domains_zone_insert AFTER INSERT ON domains
+    BEGIN
+        INSERT OR IGNORE INTO stats_counters (key, value) VALUES ('zone:' || COALESCE(NEW.zone, ''), 0);
+        UPDATE stats_counters SET value=value+1 WHERE key='zone:' || COALESCE(NEW.zone, '');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_domains_zone_delete AFTER DELETE ON domains
+    BEGIN
+        UPDATE stats_counters SET value=value-1 WHERE key='zone:' || COALESCE(OLD.zone, '');
+    END;
+    """)
+    if "zone" not in domain_cols:
+        cur.execute("DELETE FROM stats_counters WHERE key LIKE 'zone:%'")
+        cur.execute("""
+        INSERT INTO stats_counters (key, value)
+        SELECT 'zone:' || COALESCE(zone, ''), COUNT(*) FROM domains GROUP BY 1
+        """)
+
+    # referral stats: referred_at + (referred_by, referred_at) index for per-referrer ranges,
+    # ref_counts maintained by trigger for the leaderboard
+    cur.execute("PRAGMA table_info(users)")
+    if "referred_at" not in [r[1] for r in cur.fetchall()]:
+        cur.execute("ALTER TABLE users ADD COLUMN referred_at TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_referred ON users(referred_by, referred_at)")
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ref_counts'")
+    ref_counts_exists = cur.fetchone() is not None
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ref_counts (
+        user_id INTEGER PRIMARY KEY,
+        invites INTEGER DEFAULT 0,
+        last_at TEXT
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ref_counts_invites ON ref_counts(invites)")
+    cur.executescript("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_referred AFTER UPDATE OF referred_by ON users
+    WHEN OLD.referred_by IS NULL AND NEW.referred_by IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO ref_counts (user_id) VALUES (NEW.referred_by);
+        UPDATE ref_counts SET invites=invites+1, last_at=NEW.referred_at WHERE user_id=NEW.referred_by;
+    END;
+    """)
+    if not ref_counts_exists:
+        cur.execute("""
+        INSERT INTO ref_counts (user_id, invites)
+        SELECT referred_by, COUNT(*) FROM users WHERE referred_by IS NOT NULL GROUP BY referred_by
+        """)
+
+    # persisted conversation state (see ConversationStore)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS conv_state (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at REAL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conv_state_updated ON conv_state(updated_at)")
+
+    # quota: per-user limit override (NULL = DAILY_LIMIT), a row for every user so the hot
+    # path is a single conditional UPDATE, and per-day history kept by triggers
+    cur.execute("PRAGMA table_info(quota)")
+    if "daily_limit" not in [r[1] for r in cur.fetchall()]:
+        cur.execute("ALTER TABLE quota ADD COLUMN daily_limit INTEGER")
+    cur.execute("""
+    INSERT OR IGNORE INTO quota (user_id, used, bonus, last_date)
+    SELECT user_id, 0, 0, date('now') FROM users
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS quota_daily (
+        day TEXT,
+        user_id INTEGER,
+        attempts INTEGER DEFAULT 0,
+        successes INTEGER DEFAULT 0,
+        refunds INTEGER DEFAULT 0,
+        PRIMARY KEY (day, user_id)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_quota_daily_user ON quota_daily(user_id, day)")
+    # an attempt either raises `used` or, on a row consume_attempt caught up to a new day,
+    # moves last_date forward with used=1 (the rollover itself leaves used=0)
+    cur.executescript("""
+    DROP TRIGGER IF EXISTS trg_quota_attempt;
+    CREATE TRIGGER trg_quota_attempt AFTER UPDATE OF used ON quota
+    WHEN NEW.used > OLD.used OR (NEW.last_date IS NOT OLD.last_date AND NEW.used > 0)
+    BEGIN
+        INSERT OR IGNORE INTO quota_daily (day, user_id) VALUES (date('now'), NEW.user_id);
+        UPDATE quota_daily SET attempts=attempts+1 WHERE day=date('now') AND user_id=NEW.user_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_quota_refund AFTER UPDATE OF used ON quota
+    WHEN NEW.used < OLD.used AND NEW.last_date IS OLD.last_date
+    BEGIN
+        UPDATE quota_daily SET refunds=refunds+1 WHERE day=date('now') AND user_id=NEW.user_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_quota_success AFTER INSERT ON domains
+    BEGIN
+        UPDATE quota_daily SET successes=successes+1
+        WHERE day=substr(NEW.created_at, 1, 10) AND user_id=NEW.user_id;
+    END;
+    """)
+
+    cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    c.commit()
+
+    # a new file is still empty, so switching it to incremental auto_vacuum costs nothing
+    cur.execute("PRAGMA auto_vacuum")
+    if fresh and cur.fetchone()[0] != 2:
+        cur.execute("VACUUM")
+    return True
+
+
+def init_db(path: str = DB_PATH) -> None:
+    global conn, cur
+    with startup_phase("db connect"):
+        conn = connect_db(path)
+        cur = conn.cursor()
+    with startup_phase("schema migrate"):
+        migrated = migrate_db(conn)
+    log.info("schema version %s (%s)", SCHEMA_VERSION, "migrated" if migrated else "up to date")
+    with startup_phase("settings load"):
+        load_settings()
+    with startup_phase("i18n load"):
+        load_catalog()
+
+
+# ================== State backend ==================
+class StateBackend:
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def mget(self, keys: List[str]) -> List[Optional[str]]:
+        return [await self.get(k) for k in keys]
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def set_nx(self, key: str, value: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    async def delete(self, key: str, value: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        raise NotImplementedError
+
+    async def acquire(self, key: str, ttl: float = STATE_LOCK_TTL, wait: float = 0) -> Optional[str]:
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        while True:
+            if await self.set_nx(key, token, ttl):
+                return token
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(0.05)
+
+    async def release(self, key: str, token: Optional[str]) -> None:
+        if token:
+            await self.delete(key, token)
+
+    async def extend(self, key: str, token: str, ttl: float) -> bool:
+        # push the expiry of a lock we still own; False if it was lost
+        raise NotImplementedError
+
+    async def keep_alive(self, key: str, token: str, ttl: float) -> None:
+        # runs beside a long handler so the lock cannot expire under it
+        while await self.extend(key, token, ttl):
+            await asyncio.sleep(ttl / 3)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: str, ttl: float = STATE_LOCK_TTL, wait: float = STATE_LOCK_WAIT):
+        token = await self.acquire(key, ttl, wait)
+        try:
+            yield token is not None
+        finally:
+            await self.release(key, token)
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    def __init__(self, sweep_every: int = 1000):
+        self.data = {}
+        self.sweep_every = sweep_every
+        self.writes = 0
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        for k in [k for k, (_, exp) in self.data.items() if exp and exp <= now]:
+            del self.data[k]
+
+    def _live(self, key: str) -> Optional[str]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires and expires <= time.monotonic():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    async def get(self, key):
+        return self._live(key)
+
+    async def set(self, key, value, ttl=None):
+        self.data[key] = (value, time.monotonic() + ttl if ttl else 0)
+        # expired keys are otherwise only dropped when read again
+        self.writes += 1
+        if self.writes % self.sweep_every == 0:
+            self.sweep()
+
+    async def set_nx(self, key, value, ttl):
+        if self._live(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key, value=None):
+        if value is None or self._live(key) == value:
+            self.data.pop(key, None)
+
+    async def extend(self, key, token, ttl):
+        if self._live(key) != token:
+            return False
+        self.data[key] = (token, time.monotonic() + ttl)
+        return True
+
+    async def incr(self, key, amount=1, ttl=None):
+        current = self._live(key)
+        value = int(current or 0) + amount
+        expires = self.data[key][1] if current is not None else (time.monotonic() + ttl if ttl else 0)
+        self.data[key] = (str(value), expires)
+        return value
+
+
+class RedisStateBackend(StateBackend):
+    def __init__(self, url: str = "", client=None, prefix: str = STATE_PREFIX):
+        try:
+            import redis.asyncio as aioredis
+            from redis.exceptions import WatchError
+        except ImportError:
+            raise RuntimeError("❌ STATE_URL is set but the 'redis' package is not installed (pip install redis)")
+        self.WatchError = WatchError
+        self.r = client if client is not None else aioredis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def k(self, key: str) -> str:
+        return self.prefix + key
+
+    async def get(self, key):
+        return await self.r.get(self.k(key))
+
+    async def mget(self, keys):
+        return await self.r.mget([self.k(k) for k in keys])
+
+    async def set(self, key, value, ttl=None):
+        await self.r.set(self.k(key), value, px=int(ttl * 1000) if ttl else None)
+
+    async def set_nx(self, key, value, ttl):
+        return bool(await self.r.set(self.k(key), value, nx=True, px=int(ttl * 1000)))
+
+    async def delete(self, key, value=None):
+        if value is None:
+            await self.r.delete(self.k(key))
+            return
+        # compare-and-delete (WATCH/MULTI) so a lock is only released by its owner
+        async with self.r.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.k(key))
+                if await pipe.get(self.k(key)) == value:
+                    pipe.multi()
+                    pipe.delete(self.k(key))
+                    await pipe.execute()
+                else:
+                    await pipe.unwatch()
+            except self.WatchError:
+                pass
+
+    async def extend(self, key, token, ttl):
+        async with self.r.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.k(key))
+                if await pipe.get(self.k(key)) != token:
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.pexpire(self.k(key), int(ttl * 1000))
+                await pipe.execute()
+                return True
+            except self.WatchError:
+                return False
+
+    async def incr(self, key, amount=1, ttl=None):
+        value = await self.r.incrby(self.k(key), amount)
+        if ttl and value == amount:
+            await self.r.pexpire(self.k(key), int(ttl * 1000))
+        return int(value)
+
+    async def close(self):
+        await self.r.aclose()
+
+
+def make_state_backend(url: str = STATE_URL) -> StateBackend:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateBackend(url)
+    return MemoryStateBackend()
+
+
+STATE: StateBackend = MemoryStateBackend()
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS settings (
-    key TEXT PRIMARY KEY,
-    value TEXT
-)
-""")
-
-# defaults
-cur.execute("""
-INSERT OR IGNORE INTO settings (key, value)
-VALUES ('welcome_message_ar', '👋 مرحبًا بك\\n\\n✅ اضغط زر 🔗 ربط IP ثم أرسل IP فقط.')
-""")
-cur.execute("""
-INSERT OR IGNORE INTO settings (key, value)
-VALUES ('welcome_message_en', '👋 Welcome\\n\\n✅ Tap 🔗 Link IP then send IP only.')
-""")
-cur.execute("""
-INSERT OR IGNORE INTO settings (key, value)
-VALUES ('help_message_ar', 'ℹ️ المساعدة\\n\\n1) اضغط 🔗 ربط IP\\n2) أرسل IP فقط\\n3) راح ينشئ دومين عشوائي + A + NS\\n\\n⏱️ الحد اليومي: 5')
-""")
-cur.execute("""
-INSERT OR IGNORE INTO settings (key, value)
-VALUES ('help_message_en', 'ℹ️ Help\\n\\n1) Tap 🔗 Link IP\\n2) Send IP only\\n3) It will create random domain + A + NS\\n\\n⏱️ Daily limit: 5')
-""")
-cur.execute("""
-INSERT OR IGNORE INTO settings (key, value)
-VALUES ('bot_status', 'on')
-""")
-cur.execute("""
-INSERT OR IGNORE INTO settings (key, value)
-VALUES ('force_channels', ?)
-""", (json.dumps(["@eshop_2"]),))
-
-conn.commit()
 
 # ================== i18n ==================
-TXT = {
-    "ar": {
-        "btn_link_ip": "🔗 ربط IP",
-        "btn_my_domains": "📂 دوميناتي",
-        "btn_invite": "🎁 رابط دعوتي",
-        "btn_quota": "📊 المتبقي اليومي",
-        "btn_help": "🆘 مساعدة",
-        "btn_admin": "🛠 لوحة الأدمن",
-
-        "ask_ip": "📥 أرسل IP الآن:",
-        "quota_admin": "👑 أنت أدمن — بدون حدود محاولات ✅",
-        "not_allowed_daily": "❌ وصلت الحد اليومي. جرّب باچر.",
-        "no_domains": "📂 ما عندك دومينات مضافة لحد الآن.",
-        "bot_off": "⛔ البوت متوقف مؤقتًا.",
-        "banned": "⛔ تم حظرك من استخدام البوت.",
-        "must_sub": "🔒 يجب الاشتراك في القناة/القنوات أولاً.\n\nبعد الاشتراك اضغط ✅ تحقق من الاشتراك",
-        "sub_bad": "❌ لست مشتركًا بعد.\nاشترك ثم اضغط ✅ تحقق من الاشتراك",
-        "sub_ok": "✅ تم التحقق! تفضل استخدم البوت.",
-        "lang_choose": "🌐 اختر اللغة:",
-        "lang_saved": "✅ تم حفظ اللغة.",
-        "back_main": "✅ رجعناك للقائمة الرئيسية",
-
-        "admin_title": "🛠 لوحة تحكم الأدمن",
-        "admin_users": "👥 إدارة المستخدمين",
-        "admin_stats": "📊 إحصائيات",
-        "admin_ban": "🚫 حظر مستخدم",
-        "admin_unban": "✅ رفع حظر",
-        "admin_broadcast": "📢 إذاعة",
-        "admin_channels": "📣 قنوات الاشتراك الإجباري",
-        "admin_stop": "⏸️ إيقاف البوت",
-        "admin_start": "▶️ تشغيل البوت",
-        "admin_edit_welcome": "✏️ تعديل رسالة الترحيب",
-        "admin_edit_help": "🆘 تعديل المساعدة",
-        "admin_back": "🔙 رجوع",
-
-        "ask_user_id_ban": "🆔 أرسل ID المستخدم للحظر:",
-        "ask_user_id_unban": "🆔 أرسل ID المستخدم لرفع الحظر:",
-        "ask_new_welcome": "✏️ أرسل رسالة الترحيب الجديدة الآن:",
-        "ask_new_help": "🆘 أرسل رسالة المساعدة الجديدة الآن:",
-        "ask_broadcast": "📢 أرسل رسالة الإذاعة الآن:",
-        "ban_done": "🚫 تم حظر المستخدم: {id}",
-        "unban_done": "✅ تم رفع الحظر عن: {id}",
-        "welcome_updated": "✅ تم تحديث رسالة الترحيب.",
-        "help_updated": "✅ تم تحديث رسالة المساعدة.",
-        "broadcast_done": "📢 تم إكمال الإذاعة\n\n✅ نجح: {ok}\n❌ فشل: {fail}\n👥 الإجمالي: {total}",
-        "stopped": "⛔ تم إيقاف البوت.",
-        "started": "✅ تم تشغيل البوت.",
-
-        "channels_menu": "📣 إدارة قنوات الاشتراك الإجباري",
-        "ch_show": "📋 عرض القنوات",
-        "ch_add": "➕ إضافة قناة",
-        "ch_del": "🗑️ حذف قناة",
-        "ch_back": "🔙 رجوع",
-        "ask_ch_add": "➕ أرسل معرف القناة مثل: @channel (أو بدون @)",
-        "ask_ch_del": "🗑️ أرسل معرف القناة لحذفها مثل: @channel",
-        "ch_added": "✅ تم إضافة القناة.",
-        "ch_deleted": "✅ تم حذف القناة (إن كانت موجودة).",
-        "ch_list": "📣 القنوات الحالية:\n{list}",
-
-        "copy": "📋 نسخ الاسم",
-        "delete": "🗑️ حذف",
-        "rebind": "🔁 إعادة ربط",
-        "confirm_delete": "🔒 تأكيد الحذف",
-        "cancel": "❌ إلغاء",
-        "cancelled": "❌ تم إلغاء العملية.",
-        "del_ask": "⚠️ هل أنت متأكد؟\n\n🌐 {sub}",
-        "deleted": "🗑️ تم حذف:\n{sub}",
-        "rebind_ask": "🔁 أرسل IP الجديد لـ:\n{sub}",
-
-        "invite_text": "🎁 رابط دعوتك:\n{link}\n\n✅ إذا دخل شخص جديد عبر رابطك → تنضاف لك محاولة (+1).",
-        "invite_reward": "🎉 تم قبول دعوة جديدة!\n✅ تم إضافة محاولة إضافية لك (+1).",
-    },
-    "en": {
-        "btn_link_ip": "🔗 Link IP",
-        "btn_my_domains": "📂 My Domains",
-        "btn_invite": "🎁 My Invite Link",
-        "btn_quota": "📊 Daily Remaining",
-        "btn_help": "🆘 Help",
-        "btn_admin": "🛠 Admin Panel",
-
-        "ask_ip": "📥 Send IP now:",
-        "quota_admin": "👑 You are Admin — Unlimited attempts ✅",
-        "not_allowed_daily": "❌ Daily limit reached. Try tomorrow.",
-        "no_domains": "📂 You don't have any domains yet.",
-        "bot_off": "⛔ Bot is temporarily paused.",
-        "banned": "⛔ You are banned from using this bot.",
-        "must_sub": "🔒 You must join the required channel(s) first.\n\nAfter joining, tap ✅ Check Subscription",
-        "sub_bad": "❌ Not subscribed yet.\nJoin then tap ✅ Check Subscription",
-        "sub_ok": "✅ Verified! You can use the bot now.",
-        "lang_choose": "🌐 Choose language:",
-        "lang_saved": "✅ Language saved.",
-        "back_main": "✅ Back to main menu",
-
-        "admin_title": "🛠 Admin Panel",
-        "admin_users": "👥 Users",
-        "admin_stats": "📊 Stats",
-        "admin_ban": "🚫 Ban User",
-        "admin_unban": "✅ Unban User",
-        "admin_broadcast": "📢 Broadcast",
-        "admin_channels": "📣 Forced Channels",
-        "admin_stop": "⏸️ Stop Bot",
-        "admin_start": "▶️ Start Bot",
-        "admin_edit_welcome": "✏️ Edit Welcome",
-        "admin_edit_help": "🆘 Edit Help",
-        "admin_back": "🔙 Back",
-
-        "ask_user_id_ban": "🆔 Send user ID to ban:",
-        "ask_user_id_unban": "🆔 Send user ID to unban:",
-        "ask_new_welcome": "✏️ Send new welcome message now:",
-        "ask_new_help": "🆘 Send new help message now:",
-        "ask_broadcast": "📢 Send broadcast message now:",
-        "ban_done": "🚫 Banned user: {id}",
-        "unban_done": "✅ Unbanned user: {id}",
-        "welcome_updated": "✅ Welcome message updated.",
-        "help_updated": "✅ Help message updated.",
-        "broadcast_done": "📢 Broadcast completed\n\n✅ Sent: {ok}\n❌ Failed: {fail}\n👥 Total: {total}",
-        "stopped": "⛔ Bot stopped.",
-        "started": "✅ Bot started.",
-
-        "channels_menu": "📣 Forced Channels",
-        "ch_show": "📋 Show channels",
-        "ch_add": "➕ Add channel",
-        "ch_del": "🗑️ Remove channel",
-        "ch_back": "🔙 Back",
-        "ask_ch_add": "➕ Send channel username like: @channel (or without @)",
-        "ask_ch_del": "🗑️ Send channel username to remove like: @channel",
-        "ch_added": "✅ Channel added.",
-        "ch_deleted": "✅ Channel removed (if existed).",
-        "ch_list": "📣 Current channels:\n{list}",
-
-        "copy": "📋 Copy",
-        "delete": "🗑️ Delete",
-        "rebind": "🔁 Re-link",
-        "confirm_delete": "🔒 Confirm delete",
-        "cancel": "❌ Cancel",
-        "cancelled": "❌ Cancelled.",
-        "del_ask": "⚠️ Are you sure?\n\n🌐 {sub}",
-        "deleted": "🗑️ Deleted:\n{sub}",
-        "rebind_ask": "🔁 Send new IP for:\n{sub}",
-
-        "invite_text": "🎁 Your invite link:\n{link}\n\n✅ If a new user joins via your link → you get +1 attempt.",
-        "invite_reward": "🎉 New referral accepted!\n✅ You received +1 attempt.",
-    }
-}
+# Messages live in locales/<lang>.json (one file per language, "_name" is the
+# label shown in the language picker). Each language is compiled once into a
+# flat dict with the default language merged in, so t() is a single lookup.
+LOCALES_DIR = os.getenv("LOCALES_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+DEFAULT_LANG = "ar"
+
+CATALOG = {}
+
+
+def load_catalog(path: str = LOCALES_DIR) -> dict:
+    raw = {}
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".json"):
+            with open(os.path.join(path, name), encoding="utf-8") as f:
+                raw[name[:-5]] = json.load(f)
+    base = raw.get(DEFAULT_LANG, {})
+    CATALOG.clear()
+    CATALOG.update({lang: {**base, **msgs} for lang, msgs in raw.items()})
+    keyboard_cache.clear()
+    return CATALOG
+
+
+def catalog() -> dict:
+    return CATALOG or load_catalog()
 
 
 def t(lang: str, key: str) -> str:
-    lang = lang if lang in TXT else "ar"
-    return TXT[lang].get(key, TXT["ar"].get(key, key))
+    cat = catalog()
+    return cat.get(lang, cat[DEFAULT_LANG]).get(key, key)
 
 
 def get_user_lang(uid: int) -> str:
     cur.execute("SELECT lang FROM users WHERE user_id=?", (uid,))
     row = cur.fetchone()
-    if row and row[0] in ("ar", "en"):
+    if row and row[0] in catalog():
         return row[0]
-    return "ar"
+    return DEFAULT_LANG
 
 
 def set_user_lang(uid: int, lang: str) -> None:
@@ -301,9 +725,30 @@ def today_iso() -> str:
     return datetime.now(timezone.utc).date().isoformat()
 
 
+def fmt_interval(seconds: int) -> str:
+    return f"{seconds // 60} min" if seconds >= 60 else f"{seconds} s"
+
+
+# settings are read several times per update; the cache is invalidated across
+# processes through the "settings:ver" counter in the state backend
+settings_cache = {}
+settings_ver = {"seen": None, "dirty": False}
+keyboard_cache = {}
+
+
+def load_settings() -> None:
+    settings_cache.clear()
+    cur.execute("SELECT key, value FROM settings")
+    settings_cache.update(cur.fetchall())
+
+
 def get_setting(key: str, default: str = "") -> str:
+    if key in settings_cache:
+        value = settings_cache[key]
+        return default if value is None else value
     cur.execute("SELECT value FROM settings WHERE key=?", (key,))
     row = cur.fetchone()
+    settings_cache[key] = row[0] if row else None
     return row[0] if row else default
 
 
@@ -313,24 +758,253 @@ def set_setting(key: str, value: str) -> None:
     ON CONFLICT(key) DO UPDATE SET value=excluded.value
     """, (key, value))
     conn.commit()
+    settings_cache[key] = value
+    settings_ver["dirty"] = True
+    keyboard_cache.clear()
 
 
 def bot_is_on() -> bool:
     return get_setting("bot_status", "on") == "on"
 
 
+def get_counter(key: str) -> int:
+    cur.execute("SELECT value FROM stats_counters WHERE key=?", (key,))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def get_counters() -> dict:
+    cur.execute("SELECT key, value FROM stats_counters")
+    return {k: int(v) for k, v in cur.fetchall()}
+
+
+def get_daily_series(days: int = 14) -> List[Tuple[str, int, int, int]]:
+    cur.execute(
+        "SELECT day, new_users, domains_created, domains_deleted FROM stats_daily ORDER BY day DESC LIMIT ?",
+        (days,)
+    )
+    return list(reversed(cur.fetchall()))
+
+
+def growth_chart(rows: List[Tuple[str, int, int, int]], width: int = 12) -> str:
+    if not rows:
+        return "-"
+    peak = max(max(r[1], r[2]) for r in rows) or 1
+    lines = []
+    for day, new_users, created, deleted in rows:
+        ubar = "▇" * max(1 if new_users else 0, round(new_users * width / peak))
+        dbar = "▇" * max(1 if created else 0, round(created * width / peak))
+        lines.append(f"{day[5:]} 👤{new_users:>4} {ubar}\n      🌐{created:>4} {dbar} (-{deleted})")
+    return "\n".join(lines)
+
+
+def parse_ip(text: str) -> Optional[Tuple[str, str]]:
+    try:
+        addr = ipaddress.ip_address(text.strip())
+    except ValueError:
+        return None
+    if addr.is_unspecified or addr.is_loopback or addr.is_multicast or addr.is_reserved or addr.is_link_local:
+        return None
+    if addr.version == 6 and addr.ipv4_mapped:
+        return None
+    if not addr.is_global and not ALLOW_PRIVATE_IPS:
+        return None
+    return str(addr), ("A" if addr.version == 4 else "AAAA")
+
+
+def ip_rtype(ip: str) -> str:
+    return "AAAA" if ":" in (ip or "") else "A"
+
+
 def random_label(length: int = 6) -> str:
     chars = string.ascii_lowercase + string.digits
     return "".join(random.choice(chars) for _ in range(length))
 
 
-def cf_headers():
-    return {"Authorization": f"Bearer {CF_API_TOKEN}", "Content-Type": "application/json"}
+class CircuitOpen(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    # closed -> open when the rolling failure rate is too high; open -> half_open after the
+    # cooldown, where a single probe call decides between closed and open again.
+    # Cloudflare calls run in worker threads too, hence the lock.
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_at = 0.0
+        self.calls = deque()  # (monotonic ts, failed, latency)
+        self.lock = threading.Lock()
+
+    def ready(self) -> bool:
+        # cheap pre-check that does not claim the half-open probe
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open":
+                return now - self.opened_at >= BREAKER_COOLDOWN
+            if self.state == "half_open":
+                return not self.probing or now - self.probe_at >= BREAKER_COOLDOWN
+            return True
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= BREAKER_COOLDOWN:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "closed":
+                return True
+            # a probe that never reported back (cancelled) is given up after one cooldown
+            if self.state == "half_open" and (not self.probing or now - self.probe_at >= BREAKER_COOLDOWN):
+                self.probing = True
+                self.probe_at = now
+                return True
+            return False
+
+    def record(self, ok: bool, latency: float) -> None:
+        failed = not ok or latency >= BREAKER_SLOW_CALL
+        now = time.monotonic()
+        with self.lock:
+            if self.state == "half_open":
+                self.probing = False
+                if failed:
+                    self._trip(now)
+                else:
+                    self.state = "closed"
+                    self.calls.clear()
+                    log.warning("circuit %s: closed", self.name)
+                return
+            self.calls.append((now, failed, latency))
+            while self.calls and now - self.calls[0][0] > BREAKER_WINDOW:
+                self.calls.popleft()
+            if self.state == "closed" and len(self.calls) >= BREAKER_MIN_CALLS:
+                failures = sum(1 for c in self.calls if c[1])
+                if failures / len(self.calls) >= BREAKER_ERROR_RATE:
+                    self._trip(now)
+
+    def _trip(self, now: float) -> None:
+        self.state = "open"
+        self.opened_at = now
+        self.calls.clear()
+        log.warning("circuit %s: open for %.0fs", self.name, BREAKER_COOLDOWN)
+
+
+TG_BREAKER = CircuitBreaker("telegram")
+
+
+class Zone:
+    # one Cloudflare zone new domains can be placed in; each has its own token, breaker
+    # and the nameservers DNS verification asks
+    def __init__(self, zone_id: str, domain: str, token: str, ns: Optional[List[str]] = None):
+        self.id = zone_id
+        self.domain = domain
+        self.token = token
+        self.ns = ns or []
+        self.breaker = CircuitBreaker(f"cloudflare:{domain}")
+
+
+ZONES: List[Zone] = []
+zone_rr = {"next": 0}
+
+
+def load_zones() -> List[Zone]:
+    global ZONES
+    zone_ns = {}
+    for item in CF_ZONE_NS.split(","):
+        domain, _, servers = item.partition("=")
+        if domain.strip():
+            zone_ns[domain.strip().lower()] = [s.strip() for s in servers.split("|") if s.strip()]
+    pool = [Zone(CF_ZONE_ID, CF_BASE_DOMAIN, CF_API_TOKEN, [ns for ns in (NS1, NS2) if ns])]
+    for item in CF_ZONES.split(","):
+        parts = [p.strip() for p in item.strip().split(":", 2)]
+        if parts == [""]:
+            continue
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            raise RuntimeError(f"❌ Bad CF_ZONES entry: {item.strip()}")
+        if any(z.id == parts[0] for z in pool):
+            continue
+        domain = parts[1].lower()
+        token = parts[2] if len(parts) > 2 and parts[2] else CF_API_TOKEN
+        pool.append(Zone(parts[0], domain, token, zone_ns.get(domain)))
+    ZONES = pool
+    return ZONES
+
+
+def zones() -> List[Zone]:
+    return ZONES or load_zones()
+
+
+def get_zone(zone_id: Optional[str]) -> Zone:
+    if not zone_id:
+        return zones()[0]
+    for z in zones():
+        if z.id == zone_id:
+            return z
+    raise RuntimeError(f"zone {zone_id} is not configured")
+
+
+def zone_load(zone: Zone) -> int:
+    n = get_counter(f"zone:{zone.id}")
+    if zone is zones()[0]:
+        n += get_counter("zone:")
+    return n
+
+
+def pick_zone() -> Optional[Zone]:
+    # zones whose breaker is open are skipped; None when all of them are
+    pool = [z for z in zones() if z.breaker.ready()]
+    if not pool:
+        return None
+    if ZONE_POLICY == "round_robin":
+        zone_rr["next"] += 1
+        return pool[zone_rr["next"] % len(pool)]
+    return min(pool, key=zone_load)
+
+http_session = None
+
+
+def cf_http():
+    # imported on first use to keep module import light; one pooled keep-alive session
+    global http_session
+    if http_session is None:
+        import requests
+        http_session = requests.Session()
+    return http_session
+
+
+def cf_headers(zone: Zone):
+    return {"Authorization": f"Bearer {zone.token}", "Content-Type": "application/json"}
 
 
-def cf_find_record(name: str, rtype: str) -> Optional[dict]:
+def cf_request(zone: Zone, method: str, path: str, background: bool = False, **kwargs):
+    # background (reaper, bulk listing): only runs while the breaker is closed and never
+    # feeds it, so its bursts and 429s cannot turn user requests into service_busy
+    if background:
+        if zone.breaker.state != "closed":
+            raise CircuitOpen("Cloudflare is unavailable, try again shortly")
+    elif not zone.breaker.allow():
+        raise CircuitOpen("Cloudflare is unavailable, try again shortly")
+    t0 = time.perf_counter()
+    try:
+        r = getattr(cf_http(), method)(f"{CF_API}/zones/{zone.id}{path}", headers=cf_headers(zone), **kwargs)
+    except Exception:
+        if not background:
+            zone.breaker.record(False, time.perf_counter() - t0)
+        if RECORDER:
+            RECORDER.write("cf", m=method, s=0, ms=round((time.perf_counter() - t0) * 1000, 1))
+        raise
+    if not background:
+        zone.breaker.record(r.status_code < 500 and r.status_code != 429, time.perf_counter() - t0)
+    if RECORDER:
+        RECORDER.write("cf", m=method, s=r.status_code, ms=round((time.perf_counter() - t0) * 1000, 1))
+    return r
+
+
+def cf_find_record(zone: Zone, name: str, rtype: str) -> Optional[dict]:
     params = {"type": rtype, "name": name}
-    r = requests.get(f"{CF_API}/zones/{CF_ZONE_ID}/dns_records", headers=cf_headers(), params=params, timeout=20)
+    r = cf_request(zone, "get", "/dns_records", params=params, timeout=20)
     r.raise_for_status()
     data = r.json()
     if not data.get("success"):
@@ -339,27 +1013,28 @@ def cf_find_record(name: str, rtype: str) -> Optional[dict]:
     return results[0] if results else None
 
 
-def cf_upsert_record(rtype: str, name: str, content: str, proxied: bool = False, ttl: int = 1) -> dict:
-    existing = cf_find_record(name, rtype)
-    payload = {"type": rtype, "name": name, "content": content, "ttl": ttl}
+def cf_upsert_record(zone: Zone, rtype: str, name: str, content: str, proxied: bool = False, ttl: int = 1,
+                     record_id: Optional[str] = None) -> dict:
+    payload = {"type": rtype, "name": name, "content": content, "ttl": ttl, "comment": CF_RECORD_COMMENT}
     if rtype in ("A", "AAAA", "CNAME"):
         payload["proxied"] = proxied
 
+    # known record id: skip the lookup GET; fall back to it if the record is gone
+    if record_id:
+        r = cf_request(zone, "put", f"/dns_records/{record_id}", json=payload, timeout=20)
+        if r.status_code != 404:
+            r.raise_for_status()
+            data = r.json()
+            if not data.get("success"):
+                raise RuntimeError(str(data))
+            return data["result"]
+
+    existing = cf_find_record(zone, name, rtype)
     if existing:
         rid = existing["id"]
-        r = requests.put(
-            f"{CF_API}/zones/{CF_ZONE_ID}/dns_records/{rid}",
-            headers=cf_headers(),
-            json=payload,
-            timeout=20
-        )
+        r = cf_request(zone, "put", f"/dns_records/{rid}", json=payload, timeout=20)
     else:
-        r = requests.post(
-            f"{CF_API}/zones/{CF_ZONE_ID}/dns_records",
-            headers=cf_headers(),
-            json=payload,
-            timeout=20
-        )
+        r = cf_request(zone, "post", "/dns_records", json=payload, timeout=20)
     r.raise_for_status()
     data = r.json()
     if not data.get("success"):
@@ -367,9 +1042,9 @@ def cf_upsert_record(rtype: str, name: str, content: str, proxied: bool = False,
     return data["result"]
 
 
-def cf_delete_records(name: str, rtype: str) -> int:
+def cf_delete_records(zone: Zone, name: str, rtype: str, background: bool = False) -> int:
     params = {"type": rtype, "name": name}
-    r = requests.get(f"{CF_API}/zones/{CF_ZONE_ID}/dns_records", headers=cf_headers(), params=params, timeout=20)
+    r = cf_request(zone, "get", "/dns_records", background, params=params, timeout=20)
     r.raise_for_status()
     data = r.json()
     if not data.get("success"):
@@ -378,7 +1053,7 @@ def cf_delete_records(name: str, rtype: str) -> int:
     deleted = 0
     for rec in results:
         rid = rec["id"]
-        rr = requests.delete(f"{CF_API}/zones/{CF_ZONE_ID}/dns_records/{rid}", headers=cf_headers(), timeout=20)
+        rr = cf_request(zone, "delete", f"/dns_records/{rid}", background, timeout=20)
         rr.raise_for_status()
         d2 = rr.json()
         if d2.get("success"):
@@ -386,6 +1061,65 @@ def cf_delete_records(name: str, rtype: str) -> int:
     return deleted
 
 
+def cf_batch_create(zone: Zone, records: List[dict]) -> List[dict]:
+    r = cf_request(zone, "post", "/dns_records/batch", json={"posts": records}, timeout=60)
+    r.raise_for_status()
+    data = r.json()
+    if not data.get("success"):
+        raise RuntimeError(str(data))
+    return (data.get("result") or {}).get("posts", [])
+
+
+def cf_list_records(zone: Zone, rtype: Optional[str], per_page: int = 100, comment: Optional[str] = None,
+                    delay: float = 0.0, background: bool = False):
+    # delay: pause between pages, so listing a large zone is not one burst of GETs
+    page = 1
+    while True:
+        params = {"per_page": per_page, "page": page}
+        if rtype:
+            params["type"] = rtype
+        if comment:
+            params["comment.exact"] = comment
+        r = cf_request(zone, "get", "/dns_records", background, params=params, timeout=20)
+        r.raise_for_status()
+        data = r.json()
+        if not data.get("success"):
+            raise RuntimeError(str(data))
+        yield from data.get("result", [])
+        info = data.get("result_info") or {}
+        if page >= int(info.get("total_pages") or 1):
+            return
+        page += 1
+        if delay:
+            time.sleep(delay)
+
+
+def cf_create_record(zone: Zone, rtype: str, name: str, content: str, proxied: bool = False, ttl: int = 1) -> dict:
+    # create-only: an existing identical record comes back as an error (81057), never overwritten
+    payload = {"type": rtype, "name": name, "content": content, "ttl": ttl, "comment": CF_RECORD_COMMENT}
+    if rtype in ("A", "AAAA", "CNAME"):
+        payload["proxied"] = proxied
+    r = cf_request(zone, "post", "/dns_records", json=payload, timeout=20)
+    data = r.json() if r.status_code < 500 else {}
+    if not data.get("success"):
+        r.raise_for_status()
+        raise RuntimeError(str(data.get("errors") or data))
+    return data["result"]
+
+
+def cf_zone_names(zone: Zone) -> set:
+    return {
+        rec.get("name", "").lower()
+        for rec in cf_list_records(zone, None, per_page=CF_LIST_PAGE, delay=BULK_DELAY, background=True)
+    }
+
+
+def cf_delete_record_id(zone: Zone, rid: str, background: bool = False) -> bool:
+    r = cf_request(zone, "delete", f"/dns_records/{rid}", background, timeout=20)
+    r.raise_for_status()
+    return bool(r.json().get("success"))
+
+
 def register_user(update: Update) -> bool:
     u = update.effective_user
     uid = u.id
@@ -400,6 +1134,10 @@ def register_user(update: Update) -> bool:
             "VALUES (?,?,?,?,0,NULL,0,NULL)",
             (uid, first_name, username, now_iso())
         )
+        cur.execute(
+            "INSERT OR IGNORE INTO quota (user_id, used, bonus, last_date) VALUES (?,0,0,?)",
+            (uid, today_iso())
+        )
         conn.commit()
         return True
     else:
@@ -415,31 +1153,33 @@ def user_is_banned(uid: int) -> bool:
 
 
 def ensure_quota_row(uid: int) -> None:
-    today = today_iso()
-    cur.execute("SELECT user_id FROM quota WHERE user_id=?", (uid,))
-    row = cur.fetchone()
-    if not row:
-        cur.execute("INSERT INTO quota (user_id, used, bonus, last_date) VALUES (?,?,?,?)", (uid, 0, 0, today))
-        conn.commit()
+    cur.execute(
+        "INSERT OR IGNORE INTO quota (user_id, used, bonus, last_date) VALUES (?,0,0,?)",
+        (uid, today_iso())
+    )
+    conn.commit()
 
 
-def reset_quota_if_new_day(uid: int) -> Tuple[int, int]:
+def rollover_quota() -> int:
+    # daily reset for every user in one statement; run by the midnight job and at startup
+    # (idempotent, so several workers sharing the DB may all run it). consume_attempt also
+    # resets a row it finds on an older day, covering the gap until the job has run
     today = today_iso()
-    ensure_quota_row(uid)
-    cur.execute("SELECT used, bonus, last_date FROM quota WHERE user_id=?", (uid,))
-    used, bonus, last_date = cur.fetchone()
+    cur.execute("UPDATE quota SET used=0, last_date=? WHERE last_date IS NOT ?", (today, today))
+    conn.commit()
+    return cur.rowcount
 
-    if last_date != today:
-        used = 0
-        cur.execute("UPDATE quota SET used=0, last_date=? WHERE user_id=?", (today, uid))
-        conn.commit()
 
-    return used, bonus
+def add_bonus_attempt(uid: int, amount: int = 1) -> None:
+    ensure_quota_row(uid)
+    cur.execute("UPDATE quota SET bonus=MAX(bonus+?, 0) WHERE user_id=?", (amount, uid))
+    conn.commit()
 
 
-def add_bonus_attempt(uid: int, amount: int = 1) -> None:
+def set_daily_limit(uid: int, limit: Optional[int]) -> None:
+    # None puts the user back on DAILY_LIMIT
     ensure_quota_row(uid)
-    cur.execute("UPDATE quota SET bonus=bonus+? WHERE user_id=?", (amount, uid))
+    cur.execute("UPDATE quota SET daily_limit=? WHERE user_id=?", (limit, uid))
     conn.commit()
 
 
@@ -447,24 +1187,65 @@ def consume_attempt(uid: int) -> Tuple[bool, int]:
     if is_admin(uid):
         return True, 999999
 
-    used, bonus = reset_quota_if_new_day(uid)
-    limit = DAILY_LIMIT + bonus
-
-    if used >= limit:
-        return False, 0
-
-    cur.execute("UPDATE quota SET used=used+1 WHERE user_id=?", (uid,))
+    # conditional increment keeps the limit exact when several workers share the DB
+    today = today_iso()
+    for _ in range(2):
+        cur.execute(
+            "UPDATE quota SET used=CASE WHEN last_date IS ? THEN used ELSE 0 END + 1, last_date=? "
+            "WHERE user_id=? AND (last_date IS NOT ? OR used < COALESCE(daily_limit, ?)+bonus) "
+            "RETURNING COALESCE(daily_limit, ?)+bonus-used",
+            (today, today, uid, today, DAILY_LIMIT, DAILY_LIMIT)
+        )
+        row = cur.fetchone()
+        conn.commit()
+        if row:
+            return True, row[0]
+        # no row yet (user predates the quota table) gets one and a second try
+        cur.execute("SELECT 1 FROM quota WHERE user_id=?", (uid,))
+        if cur.fetchone():
+            return False, 0
+        ensure_quota_row(uid)
+    return False, 0
+
+
+def refund_attempt(uid: int) -> None:
+    # give back an attempt whose provisioning failed before anything was created
+    if is_admin(uid):
+        return
+    cur.execute("UPDATE quota SET used=used-1 WHERE user_id=? AND used > 0", (uid,))
     conn.commit()
 
-    remaining = (limit - (used + 1))
-    return True, remaining
-
 
 def get_today_stats(uid: int) -> Tuple[int, int, int]:
     if is_admin(uid):
         return 0, 0, 999999
-    used, bonus = reset_quota_if_new_day(uid)
-    return used, bonus, DAILY_LIMIT + bonus
+    cur.execute(
+        "SELECT CASE WHEN last_date IS ? THEN used ELSE 0 END, bonus, COALESCE(daily_limit, ?) "
+        "FROM quota WHERE user_id=?",
+        (today_iso(), DAILY_LIMIT, uid)
+    )
+    row = cur.fetchone()
+    if not row:
+        return 0, 0, DAILY_LIMIT
+    used, bonus, limit = row
+    return used, bonus, limit + bonus
+
+
+def get_quota_history(uid: int = 0, days: int = 14) -> list:
+    # (day, attempts, successes, refunds), newest first; uid=0 sums all users
+    since = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+    if uid:
+        cur.execute(
+            "SELECT day, attempts, successes, refunds FROM quota_daily WHERE user_id=? AND day>=? ORDER BY day DESC",
+            (uid, since)
+        )
+    else:
+        cur.execute(
+            "SELECT day, SUM(attempts), SUM(successes), SUM(refunds) FROM quota_daily WHERE day>=? "
+            "GROUP BY day ORDER BY day DESC",
+            (since,)
+        )
+    return cur.fetchall()
 
 
 def get_force_channels() -> List[str]:
@@ -488,6 +1269,14 @@ def get_force_channels() -> List[str]:
     return ["@eshop_2"]
 
 
+SUB_BUSY = "busy"  # info value when the check was skipped because Telegram is failing
+
+
+def is_outage(e: Exception) -> bool:
+    # timeouts, connection errors and flood waits; BadRequest/Forbidden are our own problem
+    return isinstance(e, RetryAfter) or (isinstance(e, NetworkError) and not isinstance(e, BadRequest))
+
+
 async def is_user_subscribed(bot, uid: int) -> Tuple[bool, str]:
     if is_admin(uid):
         return True, ""
@@ -497,15 +1286,24 @@ async def is_user_subscribed(bot, uid: int) -> Tuple[bool, str]:
         return True, ""
 
     for ch in channels:
+        if not TG_BREAKER.allow():
+            return (True, "") if SUB_FAIL_OPEN else (False, SUB_BUSY)
+        t0 = time.perf_counter()
         try:
             member = await bot.get_chat_member(chat_id=ch, user_id=uid)
+            TG_BREAKER.record(True, time.perf_counter() - t0)
             status = str(member.status).lower()
             if status in ("member", "administrator", "creator"):
                 continue
             return False, f"{ch} | status={status}"
         except Exception as e:
+            outage = is_outage(e)
+            TG_BREAKER.record(not outage, time.perf_counter() - t0)
+            if outage and SUB_FAIL_OPEN:
+                continue
             reason = str(e)
-            if ADMIN_ID:
+            # first occurrence of a channel/reason pair goes out at once, repeats go to the digest
+            if ADMIN_ID and DIGEST.add_error(f"SUB CHECK {ch}: {reason[:120]}"):
                 try:
                     await bot.send_message(
                         ADMIN_ID,
@@ -518,25 +1316,45 @@ async def is_user_subscribed(bot, uid: int) -> Tuple[bool, str]:
     return True, ""
 
 
+async def reply_not_subscribed(message, lang: str, uid: int, info: str, key: str = "must_sub") -> None:
+    if info == SUB_BUSY:
+        await message.reply_text(t(lang, "service_busy"))
+        return
+    channels = get_force_channels()
+    if is_admin(uid) and info:
+        await message.reply_text(f"⚠️ {info}")
+    await message.reply_text(t(lang, key), reply_markup=force_join_keyboard(lang, channels))
+
+
 def force_join_keyboard(lang: str, channels: List[str]) -> InlineKeyboardMarkup:
+    key = ("force_join", tuple(channels[:3]))
+    if key in keyboard_cache:
+        return keyboard_cache[key]
     btns = []
     for ch in channels[:3]:
         username = ch.lstrip("@")
         btns.append([InlineKeyboardButton(f"🔗 {ch}", url=f"https://t.me/{username}")])
     btns.append([InlineKeyboardButton("✅ Check Subscription", callback_data="checksub")])
     btns.append([InlineKeyboardButton("🌐 Language / اللغة", callback_data="lang")])
-    return InlineKeyboardMarkup(btns)
+    keyboard_cache[key] = InlineKeyboardMarkup(btns)
+    return keyboard_cache[key]
 
 
 def language_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🇮🇶 العربية", callback_data="setlang|ar"),
-         InlineKeyboardButton("🇬🇧 English", callback_data="setlang|en")]
-    ])
+    if "lang" not in keyboard_cache:
+        btns = [InlineKeyboardButton(msgs.get("_name", lang), callback_data=f"setlang|{lang}")
+                for lang, msgs in catalog().items()]
+        keyboard_cache["lang"] = InlineKeyboardMarkup([btns[i:i + 2] for i in range(0, len(btns), 2)])
+    return keyboard_cache["lang"]
 
 
 # ================== Keyboards ==================
+# Reply keyboards are immutable PTB objects: build each (kind, language, role)
+# once and reuse it. The cache is cleared whenever settings change.
 def main_keyboard(lang: str, uid: int) -> ReplyKeyboardMarkup:
+    key = ("main", lang, is_admin(uid))
+    if key in keyboard_cache:
+        return keyboard_cache[key]
     kb = [
         [t(lang, "btn_link_ip")],
         [t(lang, "btn_my_domains")],
@@ -546,13 +1364,18 @@ def main_keyboard(lang: str, uid: int) -> ReplyKeyboardMarkup:
     ]
     if is_admin(uid):
         kb.append([t(lang, "btn_admin")])
-    return ReplyKeyboardMarkup(kb, resize_keyboard=True)
+    keyboard_cache[key] = ReplyKeyboardMarkup(kb, resize_keyboard=True)
+    return keyboard_cache[key]
 
 
 def admin_keyboard(lang: str) -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
+    key = ("admin", lang)
+    if key in keyboard_cache:
+        return keyboard_cache[key]
+    keyboard_cache[key] = ReplyKeyboardMarkup(
         [
             [t(lang, "admin_users"), t(lang, "admin_stats")],
+            [t(lang, "admin_growth"), t(lang, "admin_search"), t(lang, "admin_refs")],
             [t(lang, "admin_ban"), t(lang, "admin_unban")],
             [t(lang, "admin_broadcast")],
             [t(lang, "admin_channels")],
@@ -563,10 +1386,14 @@ def admin_keyboard(lang: str) -> ReplyKeyboardMarkup:
         ],
         resize_keyboard=True
     )
+    return keyboard_cache[key]
 
 
 def forced_channels_admin_keyboard(lang: str) -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
+    key = ("channels", lang)
+    if key in keyboard_cache:
+        return keyboard_cache[key]
+    keyboard_cache[key] = ReplyKeyboardMarkup(
         [
             [t(lang, "ch_show")],
             [t(lang, "ch_add"), t(lang, "ch_del")],
@@ -574,23 +1401,76 @@ def forced_channels_admin_keyboard(lang: str) -> ReplyKeyboardMarkup:
         ],
         resize_keyboard=True
     )
+    return keyboard_cache[key]
+
+
+# Domain buttons carry "<action>|<base36 row id>:<tag>" (well under Telegram's
+# 64-byte limit). The tag is a truncated HMAC over action, id and the user id,
+# so a payload cannot be replayed by another user or edited to another row.
+def to_base36(n: int) -> str:
+    chars = string.digits + string.ascii_lowercase
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = chars[r] + out
+        if not n:
+            return out
+
+
+def cb_tag(action: str, did: int, uid: int) -> str:
+    key = (CALLBACK_SECRET or TG_BOT_TOKEN or "").encode()
+    mac = hmac.new(key, f"{action}|{did}|{uid}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac[:6]).decode()
 
 
-def domains_inline_keyboard(lang: str, subdomain: str) -> InlineKeyboardMarkup:
+def domain_cb(action: str, did: int, uid: int) -> str:
+    return f"{action}|{to_base36(did)}:{cb_tag(action, did, uid)}"
+
+
+def parse_domain_cb(data: str, uid: int):
+    # -> row id (int), a legacy FQDN payload (str) from pre-id buttons, or None if tampered
+    action, payload = data.split("|", 1)
+    if ":" not in payload:
+        return payload
+    id36, tag = payload.split(":", 1)
+    try:
+        did = int(id36, 36)
+    except ValueError:
+        return None
+    return did if hmac.compare_digest(tag, cb_tag(action, did, uid)) else None
+
+
+def get_owned_domain(uid: int, ref) -> Optional[Tuple[int, str, str, Optional[str], Optional[str]]]:
+    if isinstance(ref, int):
+        cur.execute("SELECT id, subdomain, ip, record_id, zone, user_id FROM domains WHERE id=?", (ref,))
+    elif isinstance(ref, str):
+        cur.execute(
+            "SELECT id, subdomain, ip, record_id, zone, user_id FROM domains WHERE user_id=? AND subdomain=?",
+            (uid, ref)
+        )
+    else:
+        return None
+    row = cur.fetchone()
+    if not row or row[5] != uid:
+        return None
+    return row[:5]
+
+
+def domains_inline_keyboard(lang: str, did: int, uid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton(t(lang, "delete"), callback_data=f"askdel|{subdomain}"),
-            InlineKeyboardButton(t(lang, "copy"), callback_data=f"copy|{subdomain}"),
+            InlineKeyboardButton(t(lang, "delete"), callback_data=domain_cb("askdel", did, uid)),
+            InlineKeyboardButton(t(lang, "copy"), callback_data=domain_cb("copy", did, uid)),
         ],
         [
-            InlineKeyboardButton(t(lang, "rebind"), callback_data=f"rebind|{subdomain}")
+            InlineKeyboardButton(t(lang, "rebind"), callback_data=domain_cb("rebind", did, uid))
         ]
     ])
 
 
-def confirm_delete_keyboard(lang: str, subdomain: str) -> InlineKeyboardMarkup:
+def confirm_delete_keyboard(lang: str, did: int, uid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(lang, "confirm_delete"), callback_data=f"confirm|{subdomain}")],
+        [InlineKeyboardButton(t(lang, "confirm_delete"), callback_data=domain_cb("confirm", did, uid))],
         [InlineKeyboardButton(t(lang, "cancel"), callback_data="cancel")]
     ])
 
@@ -607,25 +1487,62 @@ def parse_ref_from_start(arg: str) -> Optional[int]:
     return None
 
 
-def reward_referral_if_needed(new_uid: int, ref_uid: int) -> bool:
+def referral_burst(ref_uid: int, now: str) -> bool:
+    # index range on (referred_by, referred_at), capped at REF_BURST_MAX rows
+    cutoff = (datetime.fromisoformat(now) - timedelta(seconds=REF_BURST_WINDOW)).isoformat()
+    cur.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM users WHERE referred_by=? AND referred_at >= ? LIMIT ?)",
+        (ref_uid, cutoff, REF_BURST_MAX)
+    )
+    return cur.fetchone()[0] >= REF_BURST_MAX
+
+
+def reward_referral_if_needed(new_uid: int, ref_uid: int) -> str:
+    # "rewarded", "burst" (recorded, no bonus) or "" when the referral does not count
     if ref_uid == new_uid:
-        return False
+        return ""
 
     cur.execute("SELECT referred_by, ref_rewarded FROM users WHERE user_id=?", (new_uid,))
     row = cur.fetchone()
     if not row:
-        return False
+        return ""
 
     referred_by, ref_rewarded = row
     if ref_rewarded == 1:
-        return False
+        return ""
     if referred_by is not None:
-        return False
+        return ""
 
-    cur.execute("UPDATE users SET referred_by=?, ref_rewarded=1 WHERE user_id=?", (ref_uid, new_uid))
+    cur.execute("SELECT 1 FROM users WHERE user_id=?", (ref_uid,))
+    if not cur.fetchone():
+        return ""
+
+    now = now_iso()
+    burst = referral_burst(ref_uid, now)
+    cur.execute(
+        "UPDATE users SET referred_by=?, referred_at=?, ref_rewarded=? WHERE user_id=?",
+        (ref_uid, now, 0 if burst else 1, new_uid)
+    )
     conn.commit()
+    if burst:
+        return "burst"
     add_bonus_attempt(ref_uid, 1)
-    return True
+    return "rewarded"
+
+
+def get_invite_count(uid: int) -> int:
+    cur.execute("SELECT invites FROM ref_counts WHERE user_id=?", (uid,))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def referral_leaderboard(limit: int = 20) -> List[Tuple[int, int, Optional[str], Optional[str], Optional[str]]]:
+    cur.execute(
+        "SELECT r.user_id, r.invites, r.last_at, u.username, u.first_name FROM ref_counts r "
+        "LEFT JOIN users u ON u.user_id=r.user_id ORDER BY r.invites DESC LIMIT ?",
+        (limit,)
+    )
+    return cur.fetchall()
 
 
 def get_invite_link(bot_username: str, uid: int) -> str:
@@ -633,12 +1550,25 @@ def get_invite_link(bot_username: str, uid: int) -> str:
 
 
 # ================== Report ==================
-def connection_report(ip: str, fqdn: str, ns_name: str, bot_username: str) -> str:
+REPORT_STATUS = {
+    "linked": "Successfully Linked 🎉",
+    "pending": "Linked, waiting for DNS ⏳",
+    "ok": "Successfully Linked 🎉\n🔎 Verified on the nameservers",
+    "failed": "Linked, not resolving yet ⚠️",
+}
+
+
+def connection_report(ip: str, fqdn: str, ns_name: str, bot_username: str, status: str = "linked",
+                      missing: Optional[List[str]] = None) -> str:
+    record = "AAAA Record (IPv6)" if ip_rtype(ip) == "AAAA" else "A Record (IPv4)"
+    status_line = REPORT_STATUS[status]
+    if missing:
+        status_line += "\nMissing: " + ", ".join(missing)
     return (
         "✅ Connection Status Report\n"
-        "Overall Status: Successfully Linked 🎉\n"
+        f"Overall Status: {status_line}\n"
         "DNS Configuration Details:\n"
-        "📍 A Record (IPv4):\n"
+        f"📍 {record}:\n"
         f"{ip}\n"
         "🌐 Domain URL:\n"
         f"{fqdn}\n"
@@ -648,15 +1578,241 @@ def connection_report(ip: str, fqdn: str, ns_name: str, bot_username: str) -> st
     )
 
 
+# ================== DNS verify ==================
+# Minimal UDP resolver: asks the zone's nameservers (NS1/NS2 or CF_ZONE_NS) directly
+# (no recursion) whether the records are served.
+DNS_TYPES = {"A": 1, "NS": 2, "AAAA": 28}
+
+dns_servers = {}  # zone id -> [(addr, port)]
+dns_pool = {"sem": None}
+
+
+def dns_verify_enabled(zone: Optional[Zone]) -> bool:
+    return DNS_VERIFY_TIMEOUT > 0 and zone is not None and bool(zone.ns)
+
+
+def dns_packet(qid: int, name: str, rtype: str) -> bytes:
+    qname = b"".join(bytes([len(p)]) + p.encode("ascii") for p in name.rstrip(".").split(".")) + b"\0"
+    return struct.pack("!HHHHHH", qid, 0, 1, 0, 0, 0) + qname + struct.pack("!HH", DNS_TYPES[rtype], 1)
+
+
+def dns_read_name(data: bytes, off: int) -> Tuple[str, int]:
+    labels = []
+    end = None
+    for _ in range(128):
+        n = data[off]
+        if n & 0xC0 == 0xC0:
+            if end is None:
+                end = off + 2
+            off = ((n & 0x3F) << 8) | data[off + 1]
+            continue
+        off += 1
+        if n == 0:
+            return ".".join(labels).lower(), (end if end is not None else off)
+        labels.append(data[off:off + n].decode("ascii", "replace"))
+        off += n
+    raise ValueError("bad name")
+
+
+def dns_parse(data: bytes, qid: int) -> Tuple[int, List[Tuple[str, int, str]]]:
+    # answer + authority sections; a delegated ns.<label> comes back as a referral in the latter
+    rid, flags, qd, an, ns, _ = struct.unpack("!HHHHHH", data[:12])
+    if rid != qid:
+        raise ValueError("id mismatch")
+    off = 12
+    for _ in range(qd):
+        off = dns_read_name(data, off)[1] + 4
+    out = []
+    for _ in range(an + ns):
+        name, off = dns_read_name(data, off)
+        rtype, _, _, rdlen = struct.unpack("!HHIH", data[off:off + 10])
+        off += 10
+        rdata = data[off:off + rdlen]
+        if rtype == 1 and rdlen == 4:
+            value = str(ipaddress.IPv4Address(rdata))
+        elif rtype == 28 and rdlen == 16:
+            value = str(ipaddress.IPv6Address(rdata))
+        elif rtype == 2:
+            value = dns_read_name(data, off)[0]
+        else:
+            value = ""
+        out.append((name, rtype, value))
+        off += rdlen
+    return flags & 0xF, out
+
+
+class DnsProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.answer = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.answer.done():
+            self.answer.set_result(data)
+
+    def error_received(self, exc):
+        if not self.answer.done():
+            self.answer.set_exception(exc)
+
+
+async def dns_query(server: Tuple[str, int], name: str, rtype: str) -> List[str]:
+    if dns_pool["sem"] is None:
+        dns_pool["sem"] = asyncio.Semaphore(DNS_CONCURRENCY)
+    qid = random.randint(0, 0xFFFF)
+    async with dns_pool["sem"]:
+        transport, proto = await asyncio.get_running_loop().create_datagram_endpoint(DnsProtocol, remote_addr=server)
+        try:
+            transport.sendto(dns_packet(qid, name, rtype))
+            data = await asyncio.wait_for(proto.answer, DNS_QUERY_TIMEOUT)
+        finally:
+            transport.close()
+    rcode, records = dns_parse(data, qid)
+    if rcode not in (0, 3):
+        raise RuntimeError(f"rcode {rcode}")
+    return [v for n, t, v in records if n == name.lower() and t == DNS_TYPES[rtype]]
+
+
+async def get_dns_servers(zone: Zone) -> List[Tuple[str, int]]:
+    # host, host:port or [v6]:port; resolved once per zone
+    if zone.id not in dns_servers:
+        loop = asyncio.get_running_loop()
+        servers = []
+        for ns in zone.ns:
+            host, port = ns, 53
+            m = re.match(r"^\[(.+)\](?::(\d+))?$", ns) or re.match(r"^([^:]+):(\d+)$", ns)
+            if m:
+                host, port = m.group(1), int(m.group(2) or 53)
+            infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+            servers.append(infos[0][4][:2])
+        dns_servers[zone.id] = servers
+    return dns_servers[zone.id]
+
+
+async def dns_check(zone: Zone, ip: str, fqdn: str, ns_name: str) -> List[str]:
+    # returns what is still missing; empty when every server answers with the new records
+    servers = await get_dns_servers(zone)
+    checks = [(srv, fqdn, ip_rtype(ip), ip) for srv in servers] + [(srv, ns_name, "NS", fqdn) for srv in servers]
+    results = await asyncio.gather(*(dns_query(srv, name, rtype) for srv, name, rtype, _ in checks),
+                                   return_exceptions=True)
+    missing = []
+    for (srv, name, rtype, want), res in zip(checks, results):
+        if isinstance(res, Exception) or want.lower() not in res:
+            missing.append(f"{rtype} @{srv[0]}")
+    return missing
+
+
+async def verify_dns(message, zone: Zone, ip: str, fqdn: str, ns_name: str, bot_username: str):
+    # background task: polls with backoff, then rewrites the report in place
+    deadline = time.monotonic() + DNS_VERIFY_TIMEOUT
+    delay = 2.0
+    while True:
+        try:
+            missing = await dns_check(zone, ip, fqdn, ns_name)
+        except Exception as e:
+            missing = [str(e)[:100]]
+        if not missing or time.monotonic() + delay > deadline:
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+    try:
+        await message.edit_text(connection_report(ip, fqdn, ns_name, bot_username, "failed" if missing else "ok", missing))
+    except:
+        pass
+
+
+async def send_report(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, zone: Optional[Zone],
+                      ip: str, fqdn: str, ns_name: str):
+    me = await context.bot.get_me()
+    status = "pending" if dns_verify_enabled(zone) else "linked"
+    report = connection_report(ip=ip, fqdn=fqdn, ns_name=ns_name, bot_username=me.username, status=status)
+    msg = await update.message.reply_text(report, reply_markup=main_keyboard(lang, update.effective_user.id))
+    if status == "pending":
+        context.application.create_task(verify_dns(msg, zone, ip, fqdn, ns_name, me.username), update=update)
+
+
 # ================== Admin notify ==================
+class AdminDigest:
+    SAMPLE = 10
+
+    def __init__(self):
+        self.users = []
+        self.user_count = 0
+        self.errors = {}
+        self.seen = set()
+        self.sent = set()  # keys sent at once in the current window
+
+    def add_user(self, uid: int, first_name: str, username: str) -> None:
+        self.user_count += 1
+        if len(self.users) < self.SAMPLE:
+            self.users.append((uid, first_name, username))
+
+    def add_error(self, key: str) -> bool:
+        # True when the key was not seen in the current or previous window
+        self.errors[key] = self.errors.get(key, 0) + 1
+        if ADMIN_DIGEST_INTERVAL <= 0:
+            return True
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        self.sent.add(key)
+        return True
+
+    def render(self) -> Optional[str]:
+        # every occurrence that did not go out at once
+        repeats = {k: n - (k in self.sent) for k, n in self.errors.items()}
+        repeats = {k: n for k, n in repeats.items() if n > 0}
+        if not self.user_count and not repeats:
+            self.reset()
+            return None
+
+        msg = f"📬 Admin digest ({fmt_interval(ADMIN_DIGEST_INTERVAL)})\n"
+        if self.user_count:
+            msg += f"\n👤 New users: {self.user_count} (Total: {get_counter('users_total')})\n"
+            for uid, fn, un in self.users:
+                msg += f"• {uid} | {fn or '-'} | {f'@{un}' if un else '-'}\n"
+            if self.user_count > len(self.users):
+                msg += f"… +{self.user_count - len(self.users)}\n"
+        if repeats:
+            msg += "\n⚠️ Repeated errors:\n"
+            for key, n in sorted(repeats.items(), key=lambda kv: -kv[1]):
+                msg += f"• {key} ×{n}\n"
+        self.reset()
+        return msg
+
+    def reset(self) -> None:
+        # error keys quiet for a whole window count as new again
+        self.seen = {k for k in self.seen if k in self.errors}
+        self.sent = set()
+        self.users = []
+        self.user_count = 0
+        self.errors = {}
+
+
+DIGEST = AdminDigest()
+
+
+async def admin_digest_job(context: ContextTypes.DEFAULT_TYPE):
+    await send_digest(context.bot)
+
+
+async def send_digest(bot) -> None:
+    msg = DIGEST.render()
+    if msg and ADMIN_ID:
+        try:
+            await bot.send_message(ADMIN_ID, msg[:4000])
+        except:
+            pass
+
+
 async def notify_admin_new_user(context: ContextTypes.DEFAULT_TYPE, update: Update):
     if not ADMIN_ID:
         return
     uid = update.effective_user.id
+    if ADMIN_DIGEST_INTERVAL > 0 and context.application.job_queue:
+        DIGEST.add_user(uid, update.effective_user.first_name, update.effective_user.username)
+        return
     uname = update.effective_user.username
     uname = f"@{uname}" if uname else "-"
-    cur.execute("SELECT COUNT(*) FROM users")
-    total_users = cur.fetchone()[0]
+    total_users = get_counter("users_total")
     await context.bot.send_message(
         ADMIN_ID,
         f"👤 New user joined\n\nID: {uid}\nName: {update.effective_user.first_name or '-'}\nUser: {uname}\nTotal: {total_users}"
@@ -676,19 +1832,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ref_uid = parse_ref_from_start(context.args[0])
     if ref_uid and is_new:
         rewarded = reward_referral_if_needed(uid, ref_uid)
-        if rewarded:
+        if rewarded == "rewarded":
             try:
                 lang_ref = get_user_lang(ref_uid)
                 await context.bot.send_message(ref_uid, t(lang_ref, "invite_reward"))
             except:
                 pass
+        elif rewarded == "burst" and ADMIN_ID and DIGEST.add_error(f"REF BURST {ref_uid}"):
+            try:
+                await context.bot.send_message(
+                    ADMIN_ID,
+                    f"⚠️ REFERRAL BURST\nReferrer: {ref_uid}\n{REF_BURST_MAX}+ joins in {fmt_interval(REF_BURST_WINDOW)}, bonus withheld"
+                )
+            except:
+                pass
 
     lang = get_user_lang(uid)
 
     # language selection if not set yet
     cur.execute("SELECT lang FROM users WHERE user_id=?", (uid,))
     row = cur.fetchone()
-    if row and (row[0] is None or row[0] not in ("ar", "en")):
+    if row and (row[0] is None or row[0] not in catalog()):
         await update.message.reply_text(t(lang, "lang_choose"), reply_markup=language_keyboard())
         return
 
@@ -701,18 +1865,102 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     ok, info = await is_user_subscribed(context.bot, uid)
     if not ok:
-        channels = get_force_channels()
-        if is_admin(uid) and info:
-            await update.message.reply_text(f"⚠️ {info}")
-        await update.message.reply_text(t(lang, "must_sub"), reply_markup=force_join_keyboard(lang, channels))
+        await reply_not_subscribed(update.message, lang, uid, info)
         return
 
-    welcome = get_setting("welcome_message_ar" if lang == "ar" else "welcome_message_en", "")
+    welcome = get_setting(f"welcome_message_{lang}", "") or get_setting(f"welcome_message_{DEFAULT_LANG}", "")
     if not welcome:
         welcome = t(lang, "btn_help")
     await update.message.reply_text(welcome, reply_markup=main_keyboard(lang, uid))
 
 
+# ================== Admin search ==================
+SEARCH_PAGE = 10
+
+
+def like_prefix(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def admin_search_users(q: str, after: int = 0, limit: int = SEARCH_PAGE) -> list:
+    q = q.strip().lstrip("@")
+    if not q:
+        return []
+    uid = int(q) if q.isdigit() else -1
+    pat = like_prefix(q)
+    # one arm per index; the unary + keeps the planner off the rowid range so each
+    # LIKE prefix is a range scan on its NOCASE index
+    cur.execute(
+        "SELECT user_id, first_name, username, banned FROM users WHERE user_id=? AND user_id>? "
+        "UNION SELECT user_id, first_name, username, banned FROM users "
+        "WHERE username LIKE ? ESCAPE '\\' AND +user_id>? "
+        "UNION SELECT user_id, first_name, username, banned FROM users "
+        "WHERE first_name LIKE ? ESCAPE '\\' AND +user_id>? "
+        "ORDER BY user_id LIMIT ?",
+        (uid, after, pat, after, pat, after, limit)
+    )
+    return cur.fetchall()
+
+
+def admin_search_domains(q: str, after: int = 0, limit: int = SEARCH_PAGE) -> list:
+    q = q.strip().lower()
+    if not q:
+        return []
+    pat = like_prefix(q)
+    cur.execute(
+        "SELECT id, user_id, subdomain, ip FROM domains WHERE subdomain LIKE ? ESCAPE '\\' AND +id>? "
+        "UNION SELECT id, user_id, subdomain, ip FROM domains WHERE ip LIKE ? ESCAPE '\\' AND +id>? "
+        "ORDER BY id LIMIT ?",
+        (pat, after, pat, after, limit)
+    )
+    return cur.fetchall()
+
+
+def admin_search_page(lang: str, q: str, u_after: int = 0, d_after: int = 0) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    users = admin_search_users(q, u_after, SEARCH_PAGE + 1)
+    doms = admin_search_domains(q, d_after, SEARCH_PAGE + 1)
+    more = len(users) > SEARCH_PAGE or len(doms) > SEARCH_PAGE
+    users, doms = users[:SEARCH_PAGE], doms[:SEARCH_PAGE]
+
+    if not users and not doms:
+        return t(lang, "search_empty"), None
+
+    msg = f"🔎 {q}\n"
+    if users:
+        msg += "\n👥 Users:\n"
+        for u_id, fn, un, banned in users:
+            un = f"@{un}" if un else "-"
+            msg += f"• {u_id} | {fn or '-'} | {un}{' | 🚫' if banned else ''}\n"
+    if doms:
+        msg += "\n🌐 Domains:\n"
+        for _, owner, sub, ip in doms:
+            msg += f"• {sub} → {ip} | {owner}\n"
+
+    btns = []
+    if u_after or d_after:
+        btns.append(InlineKeyboardButton("⏮", callback_data="asrch|0|0"))
+    if more:
+        nu = users[-1][0] if users else u_after
+        nd = doms[-1][0] if doms else d_after
+        btns.append(InlineKeyboardButton("▶️", callback_data=f"asrch|{nu}|{nd}"))
+    return msg, (InlineKeyboardMarkup([btns]) if btns else None)
+
+
+async def find_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+    lang = get_user_lang(uid)
+    q = " ".join(context.args or []).strip()
+    if not q:
+        context.user_data["admin_wait_search"] = True
+        await update.message.reply_text(t(lang, "ask_search"))
+        return
+    context.user_data["admin_search_q"] = q
+    msg, kb = admin_search_page(lang, q)
+    await update.message.reply_text(msg, reply_markup=kb)
+
+
 # ================== Admin Text Handlers ==================
 async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, lang: str) -> bool:
     uid = update.effective_user.id
@@ -728,23 +1976,44 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return True
 
     if text == t(lang, "admin_stats"):
-        cur.execute("SELECT COUNT(*) FROM users")
-        users = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM domains")
-        domains = cur.fetchone()[0]
+        counters = get_counters()
+        users = counters.get("users_total", 0)
+        domains = counters.get("domains_active", 0)
         bot_status = "✅ ON" if bot_is_on() else "⛔ OFF"
         channels = get_force_channels()
+        msg = f"📊 Stats\n\nUsers: {users}\nDomains: {domains}\nBot: {bot_status}\nChannels: {', '.join(channels) if channels else '-'}"
+        if len(zones()) > 1:
+            msg += "\n\n🗂 Zones:\n" + "\n".join(
+                f"• {z.domain}: {zone_load(z)}{'' if z.breaker.state == 'closed' else ' ⚠️ ' + z.breaker.state}"
+                for z in zones()
+            )
+        await update.message.reply_text(msg, reply_markup=admin_keyboard(lang))
+        return True
+
+    if text == t(lang, "admin_refs"):
+        rows = referral_leaderboard(20)
+        lines = [
+            f"{i}. {ref_uid} | {f'@{un}' if un else (fn or '-')} | {n} | {(last or '-')[:10]}"
+            for i, (ref_uid, n, last, un, fn) in enumerate(rows, 1)
+        ]
+        await update.message.reply_text(
+            "🏆 Referrals (top 20)\n\n" + ("\n".join(lines) if lines else "-"),
+            reply_markup=admin_keyboard(lang)
+        )
+        return True
+
+    if text == t(lang, "admin_growth"):
+        rows = get_daily_series(14)
         await update.message.reply_text(
-            f"📊 Stats\n\nUsers: {users}\nDomains: {domains}\nBot: {bot_status}\nChannels: {', '.join(channels) if channels else '-'}",
+            f"📈 Growth (14d)\n\n{growth_chart(rows)}",
             reply_markup=admin_keyboard(lang)
         )
         return True
 
     if text == t(lang, "admin_users"):
-        cur.execute("SELECT COUNT(*) FROM users")
-        total = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users WHERE banned=1")
-        banned = cur.fetchone()[0]
+        counters = get_counters()
+        total = counters.get("users_total", 0)
+        banned = counters.get("users_banned", 0)
         cur.execute("SELECT user_id, first_name, username, joined_at FROM users ORDER BY joined_at DESC LIMIT 15")
         rows = cur.fetchall()
         msg = f"👥 Users\n\nTotal: {total}\nBanned: {banned}\n\nLast 15:\n"
@@ -755,6 +2024,11 @@ async def handle_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text(msg, reply_markup=admin_keyboard(lang))
         return True
 
+    if text == t(lang, "admin_search"):
+        context.user_data["admin_wait_search"] = True
+        await update.message.reply_text(t(lang, "ask_search"), reply_markup=admin_keyboard(lang))
+        return True
+
     if text == t(lang, "admin_ban"):
         context.user_data["admin_wait_ban"] = True
         await update.message.reply_text(t(lang, "ask_user_id_ban"), reply_markup=admin_keyboard(lang))
@@ -855,6 +2129,14 @@ async def handle_admin_waiting_inputs(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text(t(lang, "ch_deleted"), reply_markup=forced_channels_admin_keyboard(lang))
         return True
 
+    if context.user_data.get("admin_wait_search"):
+        context.user_data["admin_wait_search"] = False
+        q = text.strip()
+        context.user_data["admin_search_q"] = q
+        msg, kb = admin_search_page(lang, q)
+        await update.message.reply_text(msg, reply_markup=kb)
+        return True
+
     if context.user_data.get("admin_wait_ban"):
         context.user_data["admin_wait_ban"] = False
         try:
@@ -881,19 +2163,13 @@ async def handle_admin_waiting_inputs(update: Update, context: ContextTypes.DEFA
 
     if context.user_data.get("admin_wait_welcome"):
         context.user_data["admin_wait_welcome"] = False
-        if lang == "ar":
-            set_setting("welcome_message_ar", text)
-        else:
-            set_setting("welcome_message_en", text)
+        set_setting(f"welcome_message_{lang}", text)
         await update.message.reply_text(t(lang, "welcome_updated"), reply_markup=admin_keyboard(lang))
         return True
 
     if context.user_data.get("admin_wait_help"):
         context.user_data["admin_wait_help"] = False
-        if lang == "ar":
-            set_setting("help_message_ar", text)
-        else:
-            set_setting("help_message_en", text)
+        set_setting(f"help_message_{lang}", text)
         await update.message.reply_text(t(lang, "help_updated"), reply_markup=admin_keyboard(lang))
         return True
 
@@ -921,6 +2197,264 @@ async def handle_admin_waiting_inputs(update: Update, context: ContextTypes.DEFA
     return False
 
 
+# ================== Flood control ==================
+# Runs before everything else (including the state hooks) and only touches
+# in-process buckets and STATE keys, so rejected updates cost no SQLite,
+# get_chat_member or Cloudflare work. With a shared STATE (several workers)
+# the limit is a per-user counter there, so it holds across all workers.
+SLOW_DOWN = "⏳ تمهل قليلاً / Slow down"
+buckets = {}
+
+
+def take_token(uid: int) -> Tuple[bool, bool]:
+    now = time.monotonic()
+    b = buckets.get(uid)
+    if b is None:
+        if len(buckets) >= 50000:
+            idle = FLOOD_BURST / FLOOD_RATE
+            for k in [k for k, v in buckets.items() if now - v[1] >= idle]:
+                del buckets[k]
+        b = buckets[uid] = [FLOOD_BURST, now, False]
+
+    tokens = min(FLOOD_BURST, b[0] + (now - b[1]) * FLOOD_RATE)
+    b[1] = now
+    if tokens >= 1:
+        b[0] = tokens - 1
+        b[2] = False
+        return True, False
+
+    # warn once per throttled streak, then drop silently
+    b[0] = tokens
+    warn = not b[2]
+    b[2] = True
+    return False, warn
+
+
+async def take_shared_token(uid: int) -> Tuple[bool, bool]:
+    # fixed window of FLOOD_BURST / FLOOD_RATE seconds allowing FLOOD_RATE * window updates
+    window = max(1.0, FLOOD_BURST / FLOOD_RATE)
+    limit = int(FLOOD_RATE * window)
+    n = await STATE.incr(f"flood:{uid}:{int(time.time() // window)}", 1, window)
+    return n <= limit, n == limit + 1
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update_user_id(update)
+    if uid is None or is_admin(uid):
+        return
+    q = update.callback_query
+
+    if q and q.data and CALLBACK_DEBOUNCE > 0:
+        digest = hashlib.sha1(q.data.encode()).hexdigest()[:16]
+        if not await STATE.set_nx(f"cb:{uid}:{digest}", "1", CALLBACK_DEBOUNCE):
+            try:
+                await q.answer()
+            except:
+                pass
+            raise ApplicationHandlerStop
+
+    if FLOOD_RATE <= 0:
+        return
+    if isinstance(STATE, RedisStateBackend):
+        allowed, warn = await take_shared_token(uid)
+    else:
+        allowed, warn = take_token(uid)
+    if allowed:
+        return
+    try:
+        if q:
+            await q.answer(SLOW_DOWN if warn else None)
+        elif warn and update.effective_message:
+            await update.effective_message.reply_text(SLOW_DOWN)
+    except:
+        pass
+    raise ApplicationHandlerStop
+
+
+# ================== Conversation store ==================
+class ConversationStore:
+    # Bounded LRU of per-user flow state in front of the conv_state table.
+    # Changes are queued in `dirty` (which also keeps evicted-but-unflushed
+    # entries readable) and written in one batch by flush(). Items are
+    # (data, touched, saved): every put() touches, but unchanged data only
+    # rewrites its row once `saved` is more than half the TTL old.
+    def __init__(self, size: int = CONV_CACHE_SIZE, ttl: float = STATE_TTL, write_behind: bool = True):
+        self.items = OrderedDict()
+        self.dirty = {}
+        self.size = size
+        self.ttl = ttl
+        self.write_behind = write_behind
+
+    def _remember(self, uid: int, data: dict, touched: float, saved: float) -> None:
+        self.items[uid] = (data, touched, saved)
+        self.items.move_to_end(uid)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def get(self, uid: int) -> dict:
+        now = time.time()
+        item = self.items.get(uid)
+        if item is None and uid in self.dirty:
+            data, touched = self.dirty[uid]
+            item = (data, touched, touched)
+        if item is None:
+            cur.execute("SELECT data, updated_at FROM conv_state WHERE user_id=?", (uid,))
+            row = cur.fetchone()
+            item = ({}, now, now)
+            if row:
+                try:
+                    item = (json.loads(row[0]), row[1], row[1])
+                except ValueError:
+                    pass
+        data, touched, saved = item
+        if data and now - touched > self.ttl:
+            data = {}
+        self._remember(uid, data, touched, saved)
+        return dict(data)
+
+    def put(self, uid: int, data: dict) -> None:
+        now = time.time()
+        prev = self.items.get(uid)
+        if prev is not None and prev[0] == data:
+            saved = prev[2]
+            if data and now - saved > self.ttl / 2:
+                saved = now
+                self.dirty[uid] = (prev[0], now)
+            self._remember(uid, prev[0], now, saved)
+            if self.write_behind or saved != now:
+                return
+        else:
+            self._remember(uid, dict(data), now, now)
+            self.dirty[uid] = (dict(data), now)
+        if not self.write_behind:
+            self.flush()
+
+    def flush(self) -> int:
+        if not self.dirty:
+            return 0
+        pending, self.dirty = self.dirty, {}
+        cur.executemany(
+            "INSERT INTO conv_state (user_id, data, updated_at) VALUES (?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+            [(uid, json.dumps(d), ts) for uid, (d, ts) in pending.items() if d]
+        )
+        cur.executemany(
+            "DELETE FROM conv_state WHERE user_id=?",
+            [(uid,) for uid, (d, _) in pending.items() if not d]
+        )
+        conn.commit()
+        return len(pending)
+
+    def expire(self) -> int:
+        cutoff = time.time() - self.ttl
+        for uid in [u for u, (d, ts, _) in self.items.items() if ts < cutoff]:
+            del self.items[uid]
+        # rows of cached users still in use are refreshed instead of deleted
+        for uid, (d, ts, saved) in list(self.items.items()):
+            if d and saved < cutoff:
+                self.dirty[uid] = (d, ts)
+                self.items[uid] = (d, ts, ts)
+        self.flush()
+        cur.execute("DELETE FROM conv_state WHERE updated_at < ?", (cutoff,))
+        conn.commit()
+        return cur.rowcount
+
+
+CONV: Optional[ConversationStore] = None
+
+
+async def conv_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    if CONV is not None:
+        CONV.flush()
+
+
+async def conv_expire_job(context: ContextTypes.DEFAULT_TYPE):
+    if CONV is not None:
+        CONV.flush()
+        CONV.expire()
+
+
+# ================== Shared state hooks ==================
+# Conversation state (context.user_data) is kept outside PTB between updates:
+# in CONV (SQLite, single process) or, with STATE_URL set, in the shared STATE
+# backend. It is loaded before the handlers run and written back (and dropped
+# from PTB's in-process dict) afterwards, under a per-user lock, so memory
+# stays flat and any worker can serve any update. An update whose lock cannot
+# be taken within STATE_LOCK_WAIT is answered "busy" and not handled.
+held_locks = {}  # id(update) -> (token, keep-alive task)
+
+
+def update_user_id(update: object) -> Optional[int]:
+    user = getattr(update, "effective_user", None)
+    return user.id if user else None
+
+
+async def state_load(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update_user_id(update)
+    if uid is None:
+        return
+    key = f"lock:user:{uid}"
+    token = await STATE.acquire(key, STATE_LOCK_TTL, STATE_LOCK_WAIT)
+    if token is None:
+        busy = t(get_user_lang(uid), "service_busy")
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(busy)
+            elif update.effective_message:
+                await update.effective_message.reply_text(busy)
+        except Exception:
+            pass
+        raise ApplicationHandlerStop
+    held_locks[id(update)] = (token, asyncio.create_task(STATE.keep_alive(key, token, STATE_LOCK_TTL)))
+
+    data = None
+    if CONV is not None:
+        data = CONV.get(uid)
+        ver = await STATE.get("settings:ver")
+    else:
+        raw, ver = await STATE.mget([f"conv:{uid}", "settings:ver"])
+        if raw:
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                pass
+    if ver != settings_ver["seen"]:
+        settings_cache.clear()
+        keyboard_cache.clear()
+        settings_ver["seen"] = ver
+
+    context.user_data.clear()
+    if data:
+        context.user_data.update(data)
+
+
+async def state_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update_user_id(update)
+    if uid is None:
+        return
+    try:
+        data = dict(context.user_data)
+        if CONV is not None:
+            CONV.put(uid, data)
+        elif data:
+            await STATE.set(f"conv:{uid}", json.dumps(data), STATE_TTL)
+        else:
+            await STATE.delete(f"conv:{uid}")
+        if settings_ver["dirty"]:
+            settings_ver["dirty"] = False
+            settings_ver["seen"] = str(await STATE.incr("settings:ver"))
+        context.application.drop_user_data(uid)
+    finally:
+        token, keeper = held_locks.pop(id(update), (None, None))
+        if keeper:
+            keeper.cancel()
+        await STATE.release(f"lock:user:{uid}", token)
+
+
+async def state_shutdown(app: Application):
+    await STATE.close()
+
+
 # ================== Guard ==================
 async def guard(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str) -> bool:
     uid = update.effective_user.id
@@ -935,10 +2469,7 @@ async def guard(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str) -
 
     ok, info = await is_user_subscribed(context.bot, uid)
     if not ok:
-        channels = get_force_channels()
-        if is_admin(uid) and info:
-            await update.message.reply_text(f"⚠️ {info}")
-        await update.message.reply_text(t(lang, "must_sub"), reply_markup=force_join_keyboard(lang, channels))
+        await reply_not_subscribed(update.message, lang, uid, info)
         return False
 
     return True
@@ -979,38 +2510,47 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == t(lang, "btn_help"):
-        help_msg = get_setting("help_message_ar" if lang == "ar" else "help_message_en", "")
+        help_msg = get_setting(f"help_message_{lang}", "") or get_setting(f"help_message_{DEFAULT_LANG}", "")
         if not help_msg:
-            help_msg = TXT[lang]["help_message_ar"] if lang == "ar" else TXT[lang]["help_message_en"]
+            help_msg = t(lang, "btn_help")
         await update.message.reply_text(help_msg, reply_markup=main_keyboard(lang, uid))
         return
 
     if text == t(lang, "btn_invite"):
         me = await context.bot.get_me()
         link = get_invite_link(me.username, uid)
-        await update.message.reply_text(t(lang, "invite_text").format(link=link), reply_markup=main_keyboard(lang, uid))
+        msg = t(lang, "invite_text").format(link=link) + "\n\n" + t(lang, "invite_count").format(n=get_invite_count(uid))
+        await update.message.reply_text(msg, reply_markup=main_keyboard(lang, uid))
         return
 
     if text == t(lang, "btn_my_domains"):
-        cur.execute("SELECT subdomain, ip, created_at FROM domains WHERE user_id=? ORDER BY id DESC LIMIT 30", (uid,))
+        cur.execute("SELECT id, subdomain, ip, created_at FROM domains WHERE user_id=? ORDER BY id DESC LIMIT 30", (uid,))
         rows = cur.fetchall()
         if not rows:
             await update.message.reply_text(t(lang, "no_domains"), reply_markup=main_keyboard(lang, uid))
             return
 
-        for sub, ip, created_at in rows:
-            label = sub.split(".", 1)[0]
-            ns_name = f"ns.{label}.{CF_BASE_DOMAIN}"
+        for did, sub, ip, created_at in rows:
+            ns_name = f"ns.{sub}"
             await update.message.reply_text(
                 f"🌐 {sub}\n➡️ {ip}\n⚙️ NS: {ns_name} → {sub}\n⏰ {created_at[:19]}",
-                reply_markup=domains_inline_keyboard(lang, sub)
+                reply_markup=domains_inline_keyboard(lang, did, uid)
             )
         return
 
     # create domain
     if context.user_data.get("await_ip"):
+        parsed = parse_ip(text)
+        if not parsed:
+            await update.message.reply_text(t(lang, "bad_ip"))
+            return
+        # fail fast before spending an attempt; the user can resend the IP once it recovers
+        zone = pick_zone()
+        if zone is None:
+            await update.message.reply_text(t(lang, "service_busy"))
+            return
         context.user_data["await_ip"] = False
-        ip = text
+        ip, rtype = parsed
 
         allowed, remaining = consume_attempt(uid)
         if not allowed:
@@ -1018,49 +2558,83 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         label = random_label(6)
-        fqdn = f"{label}.{CF_BASE_DOMAIN}"
-        ns_name = f"ns.{label}.{CF_BASE_DOMAIN}"
+        fqdn = f"{label}.{zone.domain}"
+        ns_name = f"ns.{fqdn}"
         ns_value = fqdn
 
         try:
-            cf_upsert_record("A", fqdn, ip, proxied=False, ttl=1)
-            cf_upsert_record("NS", ns_name, ns_value, ttl=1)
+            rec = await asyncio.to_thread(cf_upsert_record, zone, rtype, fqdn, ip)
+        except Exception as e:
+            refund_attempt(uid)
+            msg = t(lang, "service_busy") if isinstance(e, CircuitOpen) else f"⚠️ Cloudflare Error: {e}"
+            await update.message.reply_text(msg, reply_markup=main_keyboard(lang, uid))
+            return
+        try:
+            await asyncio.to_thread(cf_upsert_record, zone, "NS", ns_name, ns_value)
         except Exception as e:
             await update.message.reply_text(f"⚠️ Cloudflare Error: {e}", reply_markup=main_keyboard(lang, uid))
             return
 
         cur.execute(
-            "INSERT INTO domains (user_id, subdomain, ip, created_at) VALUES (?,?,?,?)",
-            (uid, fqdn, ip, now_iso())
+            "INSERT INTO domains (user_id, subdomain, ip, created_at, record_id, zone) VALUES (?,?,?,?,?,?)",
+            (uid, fqdn, ip, now_iso(), rec.get("id"), zone.id)
         )
         conn.commit()
 
-        me = await context.bot.get_me()
-        report = connection_report(ip=ip, fqdn=fqdn, ns_name=ns_name, bot_username=me.username)
-        await update.message.reply_text(report, reply_markup=main_keyboard(lang, uid))
+        await send_report(update, context, lang, zone, ip, fqdn, ns_name)
         return
 
     # rebind flow
     if context.user_data.get("rebind_domain"):
-        sub = context.user_data.pop("rebind_domain")
-        ip = text.strip()
-
-        label = sub.split(".", 1)[0]
-        ns_name = f"ns.{label}.{CF_BASE_DOMAIN}"
-        ns_value = sub
+        parsed = parse_ip(text)
+        if not parsed:
+            await update.message.reply_text(t(lang, "bad_ip"))
+            return
+        ref = context.user_data.pop("rebind_domain")
+        ip, rtype = parsed
 
-        try:
-            cf_upsert_record("A", sub, ip, proxied=False, ttl=1)
-            cf_upsert_record("NS", ns_name, ns_value, ttl=1)
-            cur.execute("UPDATE domains SET ip=? WHERE user_id=? AND subdomain=?", (ip, uid, sub))
-            conn.commit()
-        except Exception as e:
-            await update.message.reply_text(f"⚠️ Error: {e}", reply_markup=main_keyboard(lang, uid))
+        row = get_owned_domain(uid, ref)
+        if not row:
+            await update.message.reply_text(t(lang, "no_domains"), reply_markup=main_keyboard(lang, uid))
             return
+        did, sub, old_ip, record_id, zone_id = row
+        ns_name = f"ns.{sub}"
 
-        me = await context.bot.get_me()
-        report = connection_report(ip=ip, fqdn=sub, ns_name=ns_name, bot_username=me.username)
-        await update.message.reply_text(report, reply_markup=main_keyboard(lang, uid))
+        # the NS record (ns.<label> -> <sub>) never changes on rebind; only the address record is written
+        if ip != old_ip:
+            try:
+                zone = get_zone(zone_id)
+            except RuntimeError as e:
+                await update.message.reply_text(f"⚠️ Error: {e}", reply_markup=main_keyboard(lang, uid))
+                return
+            if not zone.breaker.ready():
+                context.user_data["rebind_domain"] = did
+                await update.message.reply_text(t(lang, "service_busy"))
+                return
+            old_rtype = ip_rtype(old_ip)
+            try:
+                if old_rtype == rtype:
+                    rec = await asyncio.to_thread(cf_upsert_record, zone, rtype, sub, ip, record_id=record_id)
+                else:
+                    rec = await asyncio.to_thread(cf_upsert_record, zone, rtype, sub, ip)
+                    await asyncio.to_thread(cf_delete_records, zone, sub, old_rtype)
+            except Exception as e:
+                msg = t(lang, "service_busy") if isinstance(e, CircuitOpen) else f"⚠️ Error: {e}"
+                await update.message.reply_text(msg, reply_markup=main_keyboard(lang, uid))
+                return
+            cur.execute(
+                "UPDATE domains SET ip=?, record_id=?, updated_at=? WHERE id=?",
+                (ip, rec.get("id"), now_iso(), did)
+            )
+        else:
+            cur.execute("UPDATE domains SET updated_at=? WHERE id=?", (now_iso(), did))
+        conn.commit()
+
+        try:
+            zone = get_zone(zone_id)
+        except RuntimeError:
+            zone = None  # no longer configured: report without the DNS check
+        await send_report(update, context, lang, zone, ip, sub, ns_name)
         return
 
 
@@ -1080,8 +2654,8 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("setlang|"):
         new_lang = data.split("|", 1)[1].strip()
-        if new_lang not in ("ar", "en"):
-            new_lang = "ar"
+        if new_lang not in catalog():
+            new_lang = DEFAULT_LANG
         set_user_lang(uid, new_lang)
         lang = new_lang
         await q.message.reply_text(t(lang, "lang_saved"), reply_markup=main_keyboard(lang, uid))
@@ -1092,10 +2666,23 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if ok:
             await q.message.reply_text(t(lang, "sub_ok"), reply_markup=main_keyboard(lang, uid))
         else:
-            channels = get_force_channels()
-            if is_admin(uid) and info:
-                await q.message.reply_text(f"⚠️ {info}")
-            await q.message.reply_text(t(lang, "sub_bad"), reply_markup=force_join_keyboard(lang, channels))
+            await reply_not_subscribed(q.message, lang, uid, info, "sub_bad")
+        return
+
+    if data.startswith("asrch|"):
+        if not is_admin(uid):
+            return
+        q_text = context.user_data.get("admin_search_q")
+        if not q_text:
+            await q.edit_message_text(t(lang, "search_empty"))
+            return
+        try:
+            _, u_after, d_after = data.split("|")
+            u_after, d_after = int(u_after), int(d_after)
+        except:
+            return
+        msg, kb = admin_search_page(lang, q_text, u_after, d_after)
+        await q.edit_message_text(msg, reply_markup=kb)
         return
 
     # other callbacks guarded
@@ -1107,20 +2694,22 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     ok, info = await is_user_subscribed(context.bot, uid)
     if not ok:
-        channels = get_force_channels()
-        if is_admin(uid) and info:
-            await q.message.reply_text(f"⚠️ {info}")
-        await q.message.reply_text(t(lang, "must_sub"), reply_markup=force_join_keyboard(lang, channels))
+        await reply_not_subscribed(q.message, lang, uid, info)
         return
 
+    if data.startswith(("copy|", "askdel|", "confirm|", "rebind|")):
+        row = get_owned_domain(uid, parse_domain_cb(data, uid))
+        if not row:
+            await q.edit_message_text(t(lang, "no_domains"))
+            return
+        did, sub, ip, _, zone_id = row
+
     if data.startswith("copy|"):
-        sub = data.split("|", 1)[1]
         await q.answer(sub, show_alert=True)
         return
 
     if data.startswith("askdel|"):
-        sub = data.split("|", 1)[1]
-        await q.edit_message_text(t(lang, "del_ask").format(sub=sub), reply_markup=confirm_delete_keyboard(lang, sub))
+        await q.edit_message_text(t(lang, "del_ask").format(sub=sub), reply_markup=confirm_delete_keyboard(lang, did, uid))
         return
 
     if data == "cancel":
@@ -1128,46 +2717,904 @@ async def callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data.startswith("confirm|"):
-        sub = data.split("|", 1)[1]
-        label = sub.split(".", 1)[0]
-        ns_name = f"ns.{label}.{CF_BASE_DOMAIN}"
-
         try:
-            cf_delete_records(sub, "A")
-            cf_delete_records(ns_name, "NS")
+            zone = get_zone(zone_id)
+            await asyncio.to_thread(cf_delete_records, zone, sub, ip_rtype(ip))
+            await asyncio.to_thread(cf_delete_records, zone, f"ns.{sub}", "NS")
         except Exception as e:
-            await q.edit_message_text(f"⚠️ {e}")
+            await q.edit_message_text(t(lang, "service_busy") if isinstance(e, CircuitOpen) else f"⚠️ {e}")
             return
 
-        cur.execute("DELETE FROM domains WHERE user_id=? AND subdomain=?", (uid, sub))
+        cur.execute("DELETE FROM domains WHERE id=?", (did,))
         conn.commit()
         await q.edit_message_text(t(lang, "deleted").format(sub=sub))
         return
 
     if data.startswith("rebind|"):
-        sub = data.split("|", 1)[1]
-        context.user_data["rebind_domain"] = sub
+        context.user_data["rebind_domain"] = did
         await q.message.reply_text(t(lang, "rebind_ask").format(sub=sub))
         return
 
 
+# ================== Reaper ==================
+def managed_label(name: str, rtype: str, domain: str) -> Optional[str]:
+    # records are pre-filtered on CF_RECORD_COMMENT; this only maps the name back to its label
+    suffix = "." + domain
+    if not name.endswith(suffix):
+        return None
+    head = name[:-len(suffix)]
+    if rtype == "NS":
+        if not head.startswith("ns."):
+            return None
+        head = head[3:]
+    if head and "." not in head:
+        return head
+    return None
+
+
+def record_is_stale(rec: dict) -> bool:
+    created = rec.get("created_on") or rec.get("modified_on")
+    if not created:
+        return False
+    try:
+        ts = datetime.fromisoformat(created.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    return (datetime.now(timezone.utc) - ts).total_seconds() > REAPER_GRACE
+
+
+def find_expired_domains(limit: int) -> List[Tuple[int, int, str, str, Optional[str]]]:
+    if DOMAIN_MAX_AGE_DAYS <= 0 or limit <= 0:
+        return []
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=DOMAIN_MAX_AGE_DAYS)).isoformat()
+    cur.execute(
+        "SELECT id, user_id, subdomain, ip, zone FROM domains WHERE COALESCE(updated_at, created_at) < ? "
+        "ORDER BY COALESCE(updated_at, created_at) LIMIT ?",
+        (cutoff, limit)
+    )
+    return cur.fetchall()
+
+
+async def reaper_job(context: ContextTypes.DEFAULT_TYPE):
+    # only one worker reaps at a time
+    async with STATE.lock("lock:job:reaper", ttl=REAPER_INTERVAL, wait=0) as acquired:
+        if acquired:
+            await reap(context)
+
+
+async def reap(context: ContextTypes.DEFAULT_TYPE):
+    # Cloudflare calls run in a worker thread; all SQLite access stays on the loop thread
+    budget = REAPER_BATCH
+    orphans = 0
+    expired = 0
+    errors = 0
+
+    for zone in zones():
+        if budget <= 0:
+            break
+        try:
+            records = await asyncio.to_thread(
+                lambda: [
+                    (rt, rec) for rt in ("A", "AAAA", "NS")
+                    for rec in cf_list_records(zone, rt, per_page=CF_LIST_PAGE, comment=CF_RECORD_COMMENT,
+                                               delay=REAPER_DELAY, background=True)
+                ]
+            )
+        except Exception:
+            records = []
+            errors += 1
+
+        for rtype, rec in records:
+            if budget <= 0:
+                break
+            label = managed_label(rec.get("name", ""), rtype, zone.domain)
+            if not label or not record_is_stale(rec):
+                continue
+            cur.execute("SELECT 1 FROM domains WHERE subdomain=? COLLATE NOCASE LIMIT 1", (f"{label}.{zone.domain}",))
+            if cur.fetchone():
+                continue
+            budget -= 1
+            try:
+                if await asyncio.to_thread(cf_delete_record_id, zone, rec["id"], True):
+                    orphans += 1
+            except Exception:
+                errors += 1
+            await asyncio.sleep(REAPER_DELAY)
+
+    for did, owner, sub, ip, zone_id in find_expired_domains(budget):
+        try:
+            zone = get_zone(zone_id)
+            await asyncio.to_thread(cf_delete_records, zone, sub, ip_rtype(ip), True)
+            await asyncio.to_thread(cf_delete_records, zone, f"ns.{sub}", "NS", True)
+        except Exception:
+            errors += 1
+            continue
+        cur.execute("DELETE FROM domains WHERE id=?", (did,))
+        conn.commit()
+        expired += 1
+        await asyncio.sleep(REAPER_DELAY)
+
+    if ADMIN_ID and (orphans or expired or errors):
+        try:
+            await context.bot.send_message(
+                ADMIN_ID,
+                f"🧹 Reaper\n\nOrphan records: {orphans}\nExpired domains: {expired}\nErrors: {errors}"
+            )
+        except:
+            pass
+
+
+# ================== Bulk provisioning ==================
+LABEL_RE = re.compile(r"^[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?$")
+
+
+def label_in_zone(label: str, zone: Zone, taken: set) -> bool:
+    fqdn = f"{label}.{zone.domain}"
+    return fqdn in taken or f"ns.{fqdn}" in taken
+
+
+def parse_bulk_lines(raw: str, zone: Zone, taken: set) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str]]]:
+    # taken: lower-cased names already present in the zone (cf_zone_names)
+    jobs = []
+    rejects = []
+    seen = set()
+    for row in csv.reader(io.StringIO(raw)):
+        # cells stay positional: ",label" is a missing ip, not a label-less line
+        cells = [c.strip() for c in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        if not cells or cells[0].startswith("#") or cells[0].lower() == "ip":
+            continue
+        line = ",".join(cells)
+        if len(jobs) >= BULK_MAX:
+            rejects.append((line, "over BULK_MAX"))
+            continue
+        parsed = parse_ip(cells[0])
+        if not parsed:
+            rejects.append((line, "bad ip"))
+            continue
+        label = cells[1].lower() if len(cells) > 1 else ""
+        if label:
+            if not LABEL_RE.match(label):
+                rejects.append((line, "bad label"))
+                continue
+            cur.execute("SELECT 1 FROM domains WHERE subdomain=? COLLATE NOCASE LIMIT 1", (f"{label}.{zone.domain}",))
+            if label in seen or cur.fetchone() or label_in_zone(label, zone, taken):
+                rejects.append((line, "label taken"))
+                continue
+        else:
+            label = random_label(6)
+            while label in seen or label_in_zone(label, zone, taken):
+                label = random_label(6)
+        seen.add(label)
+        jobs.append((label, parsed[0], parsed[1]))
+    return jobs, rejects
+
+
+def provision_chunk(zone: Zone, chunk: List[Tuple[str, str, str]]) -> List[Tuple[str, str, Optional[str], str]]:
+    # one batch call for all A/AAAA + NS records of the chunk; per-record creates pinpoint failures
+    records = []
+    for label, ip, rtype in chunk:
+        fqdn = f"{label}.{zone.domain}"
+        records.append({"type": rtype, "name": fqdn, "content": ip, "ttl": 1, "proxied": False,
+                        "comment": CF_RECORD_COMMENT})
+        records.append({"type": "NS", "name": f"ns.{fqdn}", "content": fqdn, "ttl": 1, "comment": CF_RECORD_COMMENT})
+
+    try:
+        created = cf_batch_create(zone, records)
+        ids = {(r.get("type"), r.get("name")): r.get("id") for r in created}
+        return [(label, ip, ids.get((rtype, f"{label}.{zone.domain}")), "") for label, ip, rtype in chunk]
+    except Exception:
+        pass
+
+    out = []
+    for label, ip, rtype in chunk:
+        fqdn = f"{label}.{zone.domain}"
+        try:
+            rec = cf_create_record(zone, rtype, fqdn, ip, proxied=False, ttl=1)
+            cf_create_record(zone, "NS", f"ns.{fqdn}", fqdn, ttl=1)
+            out.append((label, ip, rec.get("id"), ""))
+        except Exception as e:
+            out.append((label, ip, None, str(e)[:200]))
+    return out
+
+
+async def bulk_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+    lang = get_user_lang(uid)
+    owner = uid
+    if context.args and context.args[0].isdigit():
+        owner = int(context.args[0])
+    context.user_data["admin_wait_bulk"] = owner
+    await update.message.reply_text(t(lang, "ask_bulk").format(id=owner))
+
+
+async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid) or "admin_wait_bulk" not in context.user_data:
+        return
+    lang = get_user_lang(uid)
+    owner = context.user_data.pop("admin_wait_bulk")
+
+    doc = update.message.document
+    if not doc or (doc.file_size or 0) > 1024 * 1024:
+        await update.message.reply_text(t(lang, "bulk_bad_file"), reply_markup=admin_keyboard(lang))
+        return
+    f = await doc.get_file()
+    raw = bytes(await f.download_as_bytearray()).decode("utf-8", "replace")
+
+    # the whole file goes into one zone so explicit labels are checked against a single domain
+    zone = pick_zone()
+    if zone is None:
+        await update.message.reply_text(t(lang, "service_busy"), reply_markup=admin_keyboard(lang))
+        return
+    progress = await update.message.reply_text("⏳ Bulk: checking zone…")
+    # runs as a background task, like /export, so other updates are not held up by the run
+    context.application.create_task(
+        run_bulk(context.bot, update.effective_chat.id, progress, lang, owner, zone, raw),
+        update=update
+    )
+
+
+async def run_bulk(bot, chat_id: int, progress, lang: str, owner: int, zone: Zone, raw: str):
+    try:
+        taken = await asyncio.to_thread(cf_zone_names, zone)
+    except Exception as e:
+        msg = t(lang, "service_busy") if isinstance(e, CircuitOpen) else f"⚠️ Cloudflare Error: {e}"
+        await bot.send_message(chat_id, msg, reply_markup=admin_keyboard(lang))
+        return
+    jobs, rejects = parse_bulk_lines(raw, zone, taken)
+    if not jobs:
+        await bot.send_message(chat_id, t(lang, "bulk_bad_file"), reply_markup=admin_keyboard(lang))
+        return
+
+    created = 0
+    report = [("line_or_domain", "ip", "status", "error")]
+    report.extend((line, "", "rejected", reason) for line, reason in rejects)
+
+    done = 0
+    for i in range(0, len(jobs), BULK_CHUNK):
+        chunk = jobs[i:i + BULK_CHUNK]
+        results = await asyncio.to_thread(provision_chunk, zone, chunk)
+        created_at = now_iso()
+        rows = []
+        for label, ip, rid, err in results:
+            fqdn = f"{label}.{zone.domain}"
+            if err:
+                report.append((fqdn, ip, "failed", err))
+            else:
+                rows.append((owner, fqdn, ip, created_at, rid, zone.id))
+                report.append((fqdn, ip, "ok", ""))
+        # committed per chunk so a crash mid-run leaves no Cloudflare records without a row
+        cur.executemany(
+            "INSERT INTO domains (user_id, subdomain, ip, created_at, record_id, zone) VALUES (?,?,?,?,?,?)",
+            rows
+        )
+        conn.commit()
+        created += len(rows)
+        done += len(chunk)
+        try:
+            await progress.edit_text(f"⏳ Bulk: {done}/{len(jobs)}")
+        except:
+            pass
+        if done < len(jobs):
+            await asyncio.sleep(BULK_DELAY)
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(report)
+    failed = len(jobs) - created
+    await bot.send_document(
+        chat_id,
+        document=buf.getvalue().encode("utf-8"),
+        filename=f"bulk_{owner}_{today_iso()}.csv",
+        reply_markup=admin_keyboard(lang)
+    )
+    try:
+        await progress.edit_text(
+            f"✅ Bulk done\n\n👤 Owner: {owner}\n✅ Created: {created}\n❌ Failed: {failed}\n🚫 Rejected: {len(rejects)}"
+        )
+    except:
+        pass
+
+
+# ================== Export ==================
+EXPORT_TABLES = ("users", "domains", "quota")
+EXPORT_BATCH = 1000
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Bot API upload limit
+
+exports_running = set()
+
+
+def write_export(path: str, table: str, fmt: str, out) -> int:
+    # runs in a worker thread with its own read-only connection: one consistent snapshot,
+    # rows pulled in batches and gzipped straight into `out`
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=15)
+    rows = 0
+    try:
+        c = src.execute(f"SELECT * FROM {table} ORDER BY rowid")
+        cols = [d[0] for d in c.description]
+        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as gz:
+            w = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+            writer = csv.writer(w) if fmt == "csv" else None
+            if writer:
+                writer.writerow(cols)
+            while True:
+                batch = c.fetchmany(EXPORT_BATCH)
+                if not batch:
+                    break
+                if writer:
+                    writer.writerows(batch)
+                else:
+                    w.writelines(json.dumps(dict(zip(cols, r)), ensure_ascii=False) + "\n" for r in batch)
+                rows += len(batch)
+            w.flush()
+            w.detach()
+    finally:
+        src.close()
+    return rows
+
+
+async def run_export(bot, chat_id: int, uid: int, path: str, tables: List[str], fmt: str):
+    try:
+        for table in tables:
+            t0 = time.perf_counter()
+            with tempfile.TemporaryFile() as out:
+                try:
+                    rows = await asyncio.to_thread(write_export, path, table, fmt, out)
+                except Exception as e:
+                    await bot.send_message(chat_id, f"⚠️ Export {table}: {e}")
+                    continue
+                size = out.tell()
+                if size > EXPORT_MAX_BYTES:
+                    await bot.send_message(chat_id, f"⚠️ Export {table}: {size // 1024 // 1024} MB is over the upload limit")
+                    continue
+                out.seek(0)
+                await bot.send_document(
+                    chat_id,
+                    document=out,
+                    filename=f"{table}_{today_iso()}.{fmt}.gz",
+                    caption=f"📦 {table}: {rows} rows, {size // 1024} KB, {time.perf_counter() - t0:.1f}s",
+                    write_timeout=120
+                )
+    except Exception as e:
+        log.warning("export failed: %s", e)
+    finally:
+        exports_running.discard(uid)
+
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+    lang = get_user_lang(uid)
+    args = [a.lower() for a in context.args or []]
+    fmt = "ndjson" if "ndjson" in args else "csv"
+    tables = list(EXPORT_TABLES) if "all" in args else [a for a in EXPORT_TABLES if a in args]
+    if not tables:
+        await update.message.reply_text(t(lang, "export_usage"))
+        return
+    if uid in exports_running:
+        await update.message.reply_text("⏳ Export already running")
+        return
+    if await STATE.get("lock:job:maint"):
+        await update.message.reply_text("⏳ DB maintenance running, try again when it is done")
+        return
+
+    cur.execute("PRAGMA database_list")
+    path = cur.fetchone()[2]
+    exports_running.add(uid)
+    # runs as a background task; the bot keeps serving while the files are produced
+    context.application.create_task(
+        run_export(context.bot, update.effective_chat.id, uid, path, tables, fmt),
+        update=update
+    )
+    await update.message.reply_text(f"⏳ Export started: {', '.join(tables)} ({fmt})")
+
+
+# ================== Maintenance ==================
+def backup_db(path: str) -> Tuple[str, int]:
+    # VACUUM INTO copies one WAL read snapshot: writers keep going and, unlike a stepped
+    # backup(), their commits cannot restart the copy
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = os.path.join(BACKUP_DIR, f"bot-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.db")
+    if os.path.exists(name + ".part"):
+        os.remove(name + ".part")
+    src = sqlite3.connect(path, timeout=15)
+    try:
+        src.execute("VACUUM INTO ?", (name + ".part",))
+    finally:
+        src.close()
+    os.replace(name + ".part", name)
+
+    old = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("bot-") and f.endswith(".db"))
+    for f in old[:max(0, len(old) - BACKUP_KEEP)]:
+        os.remove(os.path.join(BACKUP_DIR, f))
+    return name, os.path.getsize(name)
+
+
+def run_maintenance(path: str, convert: bool = False) -> List[Tuple[str, float, str]]:
+    # worker thread with its own connection; returns (step, ms, detail) for the admin report.
+    # convert=True ("/maint vacuum") rebuilds a pre-auto_vacuum file once; that holds the
+    # write lock for the whole rebuild, so it is never done by the scheduled job
+    steps = []
+
+    def step(name, fn):
+        t0 = time.perf_counter()
+        try:
+            detail = fn()
+        except Exception as e:
+            detail = f"❌ {e}"
+        steps.append((name, (time.perf_counter() - t0) * 1000, detail))
+
+    c = sqlite3.connect(path, timeout=15)
+    try:
+        def backup():
+            name, size = backup_db(path)
+            return f"{os.path.basename(name)} {size // 1024} KB"
+
+        def analyze():
+            # analysis_limit keeps ANALYZE to a sample of each index instead of a full scan
+            c.execute("PRAGMA analysis_limit=1000")
+            c.execute("ANALYZE")
+            c.execute("PRAGMA optimize")
+            c.commit()
+            return "ok"
+
+        def vacuum():
+            if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                if not convert:
+                    return "auto_vacuum off, run /maint vacuum once"
+                c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                c.execute("VACUUM")
+                return "converted to incremental auto_vacuum"
+            free = left = c.execute("PRAGMA freelist_count").fetchone()[0]
+            # small batches, each its own short write transaction
+            while left:
+                # executescript steps the pragma to completion (execute() frees a single page)
+                c.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+                now = c.execute("PRAGMA freelist_count").fetchone()[0]
+                if now >= left:
+                    break
+                left = now
+                time.sleep(0.005)
+            c.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            return f"{free - left} pages freed"
+
+        def prune():
+            if QUOTA_HISTORY_DAYS <= 0:
+                return "kept"
+            n = c.execute("DELETE FROM quota_daily WHERE day < date('now', ?)", (f"-{QUOTA_HISTORY_DAYS} days",)).rowcount
+            c.commit()
+            return f"{n} quota_daily rows"
+
+        step("backup", backup)
+        step("prune", prune)
+        step("analyze", analyze)
+        step("vacuum", vacuum)
+        page_size = c.execute("PRAGMA page_size").fetchone()[0]
+        pages = c.execute("PRAGMA page_count").fetchone()[0]
+        steps.append(("size", 0.0, f"{page_size * pages // 1024} KB"))
+    finally:
+        c.close()
+    return steps
+
+
+async def maint_job(context: ContextTypes.DEFAULT_TYPE):
+    if exports_running:
+        log.info("maintenance skipped: export running")
+        return
+    async with STATE.lock("lock:job:maint", ttl=3600, wait=0) as acquired:
+        if acquired:
+            await maintain(context.bot)
+
+
+async def maintain(bot, chat_id: int = 0, convert: bool = False):
+    cur.execute("PRAGMA database_list")
+    path = cur.fetchone()[2]
+    t0 = time.perf_counter()
+    steps = await asyncio.to_thread(run_maintenance, path, convert)
+    total = (time.perf_counter() - t0) * 1000
+    msg = "🛠 DB maintenance\n\n" + "\n".join(
+        f"• {name}: {detail}" + (f" ({ms:.0f} ms)" if ms else "") for name, ms, detail in steps
+    ) + f"\n\nTotal: {total:.0f} ms"
+    log.info(msg.replace("\n", " "))
+    chat_id = chat_id or ADMIN_ID
+    if chat_id:
+        try:
+            await bot.send_message(chat_id, msg)
+        except:
+            pass
+
+
+async def maint_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+    if exports_running:
+        await update.message.reply_text("⏳ Export running, try again when it is done")
+        return
+    # same lock as maint_job, so a manual run never overlaps the scheduled one
+    token = await STATE.acquire("lock:job:maint", 3600, 0)
+    if token is None:
+        await update.message.reply_text("⏳ DB maintenance already running")
+        return
+
+    async def run():
+        keeper = asyncio.create_task(STATE.keep_alive("lock:job:maint", token, 3600))
+        try:
+            await maintain(context.bot, update.effective_chat.id, convert="vacuum" in (context.args or []))
+        finally:
+            keeper.cancel()
+            await STATE.release("lock:job:maint", token)
+
+    await update.message.reply_text("⏳ DB maintenance started")
+    context.application.create_task(run(), update=update)
+
+
+# ================== Quota ==================
+async def quota_rollover_job(context: ContextTypes.DEFAULT_TYPE):
+    n = rollover_quota()
+    log.info("quota rollover: %s rows reset", n)
+
+
+def quota_history_text(rows: list) -> str:
+    lines = [f"{day}  {a} / ✅ {s} / ↩️ {r}" for day, a, s, r in rows]
+    return "\n".join(lines) if lines else "-"
+
+
+async def quota_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        return
+    lang = get_user_lang(uid)
+    args = context.args or []
+    if not args:
+        await update.message.reply_text(
+            "📊 Quota (14d): attempts / ✅ successes / ↩️ refunds\n\n" + quota_history_text(get_quota_history())
+        )
+        return
+
+    try:
+        target = int(args[0])
+    except ValueError:
+        await update.message.reply_text(t(lang, "quota_usage"))
+        return
+    cur.execute("SELECT 1 FROM users WHERE user_id=?", (target,))
+    if not cur.fetchone():
+        await update.message.reply_text(f"❌ Unknown user: {target}")
+        return
+
+    try:
+        if len(args) == 3 and args[1] == "bonus":
+            add_bonus_attempt(target, int(args[2]))
+        elif len(args) == 3 and args[1] == "limit":
+            set_daily_limit(target, None if args[2] == "default" else max(0, int(args[2])))
+        elif len(args) != 1:
+            raise ValueError(args)
+    except ValueError:
+        await update.message.reply_text(t(lang, "quota_usage"))
+        return
+
+    ensure_quota_row(target)
+    cur.execute(
+        "SELECT CASE WHEN last_date IS ? THEN used ELSE 0 END, bonus, daily_limit FROM quota WHERE user_id=?",
+        (today_iso(), target)
+    )
+    used, bonus, limit = cur.fetchone()
+    base = f"{limit}" if limit is not None else f"{DAILY_LIMIT} (default)"
+    await update.message.reply_text(
+        f"📊 {target}\n\nUsed today: {used}\nLimit: {base}\nBonus: +{bonus}\n\n"
+        + quota_history_text(get_quota_history(target))
+    )
+
+
 # ================== Main ==================
+async def on_startup(app: Application):
+    global CONV
+    with startup_phase("post_init"):
+        init_db()
+        rollover_quota()  # catch up if the process was down at midnight
+        if not isinstance(STATE, RedisStateBackend):
+            CONV = ConversationStore(write_behind=app.job_queue is not None)
+    log.info("startup: ready after %.1f ms", (time.perf_counter() - STARTED) * 1000)
+
+
+async def on_stop(app: Application):
+    # the bot can still send here (post_shutdown runs after its HTTP client is closed)
+    if conn is not None:
+        await send_digest(app.bot)
+
+
+async def on_shutdown(app: Application):
+    if CONV is not None:
+        CONV.flush()
+    await state_shutdown(app)
+    if conn is not None:
+        conn.execute("PRAGMA optimize")
+        conn.close()
+    if RECORDER:
+        RECORDER.close()
+
+
+def create_app(request: Optional[BaseRequest] = None, concurrent_updates=None) -> Application:
+    # request / concurrent_updates let replay.py plug in its Bot API stand-in and timing
+    global STATE
+    check_config()
+    with startup_phase("build app"):
+        STATE = make_state_backend()
+        if RECORDER:
+            request = TimedRequest(request)
+        builder = (
+            Application.builder()
+            .token(TG_BOT_TOKEN)
+            .post_init(on_startup)
+            .post_stop(on_stop)
+            .post_shutdown(on_shutdown)
+            .concurrent_updates(concurrent_updates or max(1, UPDATE_CONCURRENCY))
+        )
+        if request is not None:
+            builder = builder.request(request)
+        app = builder.build()
+        if RECORDER:
+            app.add_handler(TypeHandler(Update, record_update), group=-3)
+        app.add_handler(TypeHandler(Update, flood_guard), group=-2)
+        app.add_handler(TypeHandler(Update, state_load), group=-1)
+        app.add_handler(TypeHandler(Update, state_save), group=1)
+        app.add_handler(CommandHandler("start", start))
+        app.add_handler(CommandHandler("find", find_cmd))
+        app.add_handler(CommandHandler("bulk", bulk_cmd))
+        app.add_handler(CommandHandler("export", export_cmd))
+        app.add_handler(CommandHandler("maint", maint_cmd))
+        app.add_handler(CommandHandler("quota", quota_cmd))
+        app.add_handler(CallbackQueryHandler(callbacks))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+        app.add_handler(MessageHandler(filters.Document.ALL, document_handler))
+
+        if app.job_queue and REAPER_INTERVAL > 0:
+            app.job_queue.run_repeating(reaper_job, interval=REAPER_INTERVAL, first=60, name="reaper")
+        if app.job_queue and MAINT_INTERVAL > 0:
+            app.job_queue.run_repeating(maint_job, interval=MAINT_INTERVAL, first=600, name="maint")
+        if app.job_queue and ADMIN_DIGEST_INTERVAL > 0:
+            app.job_queue.run_repeating(admin_digest_job, interval=ADMIN_DIGEST_INTERVAL, name="admin_digest")
+        if app.job_queue:
+            app.job_queue.run_daily(quota_rollover_job, time=dtime(0, 0, 5, tzinfo=timezone.utc), name="quota_rollover")
+            app.job_queue.run_repeating(conv_flush_job, interval=CONV_FLUSH_INTERVAL, name="conv_flush")
+            app.job_queue.run_repeating(conv_expire_job, interval=3600, first=300, name="conv_expire")
+    return app
+
+
+# ================== Recorder ==================
+# NDJSON lines, gzipped, one file per day or RECORD_MAX_MB compressed:
+#   {"t": epoch, "k": "u", "d": <Update JSON>}
+#   {"t": epoch, "k": "cf", "m": "get|put|post|delete", "s": status, "ms": latency}
+#   {"t": epoch, "k": "tg", "m": <Bot API method>, "ok": bool, "ms": latency}
+class Recorder:
+    def __init__(self, path: str, max_bytes: int, keep: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.raw = None
+        self.gz = None
+        self.day = None
+        self.flushed = 0.0
+        self.lock = threading.Lock()  # Cloudflare timings arrive from worker threads
+
+    def rotate(self) -> None:
+        self.close()
+        os.makedirs(self.path, exist_ok=True)
+        now = datetime.now(timezone.utc)
+        self.day = now.date()
+        self.raw = open(os.path.join(self.path, f"rec-{now.strftime('%Y%m%d-%H%M%S')}.ndjson.gz"), "ab")
+        self.gz = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        old = sorted(f for f in os.listdir(self.path) if f.startswith("rec-"))
+        for f in old[:max(0, len(old) - self.keep)]:
+            os.remove(os.path.join(self.path, f))
+
+    def write(self, kind: str, **fields) -> None:
+        line = json.dumps({"t": round(time.time(), 3), "k": kind, **fields}, separators=(",", ":"), ensure_ascii=False)
+        with self.lock:
+            try:
+                if self.gz is None or self.raw.tell() >= self.max_bytes or datetime.now(timezone.utc).date() != self.day:
+                    self.rotate()
+                self.gz.write(line.encode("utf-8") + b"\n")
+                # sync-flush every few seconds so a crash loses little without hurting compression
+                if time.monotonic() - self.flushed >= 5:
+                    self.gz.flush()
+                    self.raw.flush()
+                    self.flushed = time.monotonic()
+            except OSError as e:
+                log.warning("recorder: %s", e)
+
+    def close(self) -> None:
+        if self.gz is not None:
+            self.gz.close()
+            self.raw.close()
+            self.gz = self.raw = None
+
+
+RECORDER: Optional[Recorder] = Recorder(RECORD_DIR, RECORD_MAX_MB * 1024 * 1024, RECORD_KEEP) if RECORD_DIR else None
+
+
+class TimedRequest(BaseRequest):
+    # wraps the Bot API transport and records each call's latency
+    def __init__(self, inner: Optional[BaseRequest] = None):
+        # same pool as the builder's default bot request; a bare HTTPXRequest() has one connection
+        self.inner = inner or HTTPXRequest(connection_pool_size=256)
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        t0 = time.perf_counter()
+        code = 0
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data=request_data, **kwargs)
+            return code, payload
+        finally:
+            name = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+            RECORDER.write("tg", m=name, ok=code == 200, ms=round((time.perf_counter() - t0) * 1000, 1))
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    RECORDER.write("u", d=update.to_dict())
+
+
+# ================== Webhook server ==================
+# Small HTTP/1.1 server on asyncio streams: acknowledges Telegram as soon as the update is queued.
+HTTP_STATUS = {
+    200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable",
+}
+HTTP_MAX_BODY = 1024 * 1024
+
+server_state = {"ready": False, "draining": False}
+metrics = {"http_requests": 0, "updates_received": 0, "updates_rejected": 0}
+
+
+def metrics_text(app: Application) -> str:
+    lines = [
+        f"bot_uptime_seconds {time.perf_counter() - STARTED:.0f}",
+        f"bot_http_requests_total {metrics['http_requests']}",
+        f"bot_updates_received_total {metrics['updates_received']}",
+        f"bot_updates_rejected_total {metrics['updates_rejected']}",
+        f"bot_update_queue_size {app.update_queue.qsize()}",
+        f"bot_ready {int(server_state['ready'] and not server_state['draining'])}",
+    ]
+    for b in [TG_BREAKER] + [z.breaker for z in zones()]:
+        lines.append(f'bot_circuit_open{{name="{b.name}"}} {int(b.state != "closed")}')
+    if conn is not None:
+        for key, value in sorted(get_counters().items()):
+            if not key.startswith("zone:"):
+                lines.append(f"bot_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def http_route(app: Application, method: str, path: str, headers: dict, body: bytes) -> Tuple[int, str]:
+    if path == WEBHOOK_PATH:
+        if method != "POST":
+            return 405, ""
+        if server_state["draining"]:
+            return 503, ""  # Telegram retries, by then on the new instance
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+            metrics["updates_rejected"] += 1
+            return 401, ""
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except Exception:
+            return 400, ""
+        await app.update_queue.put(update)
+        metrics["updates_received"] += 1
+        return 200, ""
+    if method != "GET":
+        return 405, ""
+    if path == "/healthz":
+        return 200, "ok\n"
+    if path == "/readyz":
+        ready = server_state["ready"] and not server_state["draining"] and conn is not None
+        return (200, "ready\n") if ready else (503, "not ready\n")
+    if path == "/metrics":
+        return 200, metrics_text(app)
+    return 404, ""
+
+
+async def http_connection(app: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 75)  # idle keep-alive limit
+            if not line:
+                break
+            try:
+                method, target, version = line.decode("latin-1").split()
+            except ValueError:
+                break
+            headers = {}
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = h.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length") or 0)
+            if length > HTTP_MAX_BODY:
+                status, out = 413, ""
+                keep = False
+            else:
+                body = await reader.readexactly(length) if length else b""
+                metrics["http_requests"] += 1
+                status, out = await http_route(app, method, target.split("?", 1)[0], headers, body)
+                keep = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                        and not server_state["draining"])
+            data = out.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+                f"Content-Type: text/plain; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+            if not keep:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_webhook(app: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    server = await asyncio.start_server(lambda r, w: http_connection(app, r, w), "0.0.0.0", PORT)
+    await app.bot.set_webhook(
+        url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONN,
+    )
+    server_state["ready"] = True
+    log.info("webhook server listening on :%s%s", PORT, WEBHOOK_PATH)
+
+    try:
+        await stop.wait()
+    finally:
+        # drain: /readyz turns 503 and new posts are refused, then app.stop() processes what is
+        # already queued and waits for background tasks before the DB is closed
+        log.info("draining")
+        server_state["draining"] = True
+        server.close()
+        try:
+            await asyncio.wait_for(app.stop(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("drain timed out after %.0fs", DRAIN_TIMEOUT)
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
 def main():
-    app = Application.builder().token(TG_BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(callbacks))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    app = create_app()
 
     if WEBHOOK_BASE_URL:
-        webhook_path = f"/{TG_BOT_TOKEN}"
-        webhook_url = f"{WEBHOOK_BASE_URL}{webhook_path}"
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=webhook_path.lstrip("/"),
-            webhook_url=webhook_url,
-            allowed_updates=Update.ALL_TYPES,
-        )
+        asyncio.run(serve_webhook(app))
     else:
         app.run_polling(allowed_updates=Update.ALL_TYPES)
 
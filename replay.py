@@ -0,0 +1,253 @@
+"""Replay a RECORD_DIR capture through the bot's handlers against local stand-ins.
+
+    python replay.py --db /tmp/replay.db [--speed 10] rec-20261019-000000.ndjson.gz ...
+
+Cloudflare and the Bot API are replaced by in-process stand-ins that answer
+successfully after the latency recorded for that kind of call (--no-latency
+answers at once). --speed 0 feeds updates as fast as the bot takes them.
+Start from a backup copy of bot.db so the users/domains the traffic refers
+to exist; the file is modified by the replay.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from typing import List
+
+
+# ================== Recording ==================
+def read_events(paths: List[str]):
+    for path in sorted(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of a file that was still being written
+        except EOFError:
+            continue
+
+
+def load(paths: List[str]):
+    updates = []
+    latency = defaultdict(list)  # ("cf", method) / ("tg", api method) -> [ms]
+    for ev in read_events(paths):
+        if ev.get("k") == "u":
+            updates.append((ev["t"], ev["d"]))
+        elif ev.get("k") in ("cf", "tg"):
+            latency[(ev["k"], ev.get("m"))].append(ev.get("ms", 0.0))
+    return updates, latency
+
+
+def pick_latency(latency, kind: str, name: str) -> float:
+    samples = latency.get((kind, name))
+    return random.choice(samples) / 1000 if samples else 0.0
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# ================== Stand-ins ==================
+class CfResponse:
+    def __init__(self, result, status_code: int = 200):
+        self.status_code = status_code
+        self.result = result
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"success": True, "result": self.result, "result_info": {"total_pages": 1}}
+
+
+class CfStandIn:
+    # takes bot.cf_http()'s place; runs in the bot's worker threads, hence time.sleep
+    def __init__(self, latency, calls):
+        self.latency = latency
+        self.calls = calls
+
+    def call(self, method: str, url: str, json=None):
+        self.calls["cf " + method] += 1
+        time.sleep(pick_latency(self.latency, "cf", method))
+        if url.endswith("/batch"):
+            return CfResponse({"posts": [dict(r, id=uuid.uuid4().hex) for r in (json or {}).get("posts", [])]})
+        if method == "get":
+            return CfResponse([])
+        if method == "delete":
+            return CfResponse({"id": url.rsplit("/", 1)[-1]})
+        return CfResponse(dict(json or {}, id=uuid.uuid4().hex))
+
+    def get(self, url, **kwargs):
+        return self.call("get", url)
+
+    def post(self, url, **kwargs):
+        return self.call("post", url, kwargs.get("json"))
+
+    def put(self, url, **kwargs):
+        return self.call("put", url, kwargs.get("json"))
+
+    def delete(self, url, **kwargs):
+        return self.call("delete", url)
+
+
+def make_tg_stand_in(latency, calls):
+    from telegram.request import BaseRequest
+
+    class TgStandIn(BaseRequest):
+        # answers every Bot API method with a plausible success payload
+        def __init__(self):
+            self.message_id = 0
+
+        @property
+        def read_timeout(self):
+            return 5.0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            if "/file/bot" in url:
+                calls["tg file"] += 1
+                return 200, b""
+            name = url.rsplit("/", 1)[-1]
+            calls["tg " + name] += 1
+            await asyncio.sleep(pick_latency(latency, "tg", name))
+            params = request_data.parameters if request_data else {}
+            if name == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+            elif name == "getChatMember":
+                result = {"status": "member", "user": {"id": params.get("user_id", 0), "is_bot": False, "first_name": "-"}}
+            elif name == "getFile":
+                result = {"file_id": params.get("file_id", "f"), "file_unique_id": "f", "file_path": "documents/f"}
+            elif name.startswith(("send", "edit")):
+                self.message_id += 1
+                result = {
+                    "message_id": self.message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                    "text": params.get("text", ""),
+                }
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    return TgStandIn()
+
+
+# ================== Replay ==================
+async def replay(bot, updates, latency, speed: float, use_latency: bool):
+    from telegram import Update
+    from telegram.ext import SimpleUpdateProcessor
+
+    if not use_latency:
+        latency = {}
+    calls = defaultdict(int)
+    durations = []
+
+    class TimedProcessor(SimpleUpdateProcessor):
+        async def do_process_update(self, update, coroutine):
+            t0 = time.perf_counter()
+            await coroutine
+            durations.append((time.perf_counter() - t0) * 1000)
+
+    bot.http_session = CfStandIn(latency, calls)
+    app = bot.create_app(
+        request=make_tg_stand_in(latency, calls),
+        concurrent_updates=TimedProcessor(max(1, bot.UPDATE_CONCURRENCY)),
+    )
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    first = updates[0][0] if updates else 0
+    for ts, data in updates:
+        if speed > 0:
+            delay = (ts - first) / speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    await app.stop()  # returns once the queue is drained and handler tasks are done
+    wall = loop.time() - start
+    if app.post_stop:
+        await app.post_stop(app)
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+    print(f"updates:    {len(updates)} in {wall:.1f}s ({len(updates) / wall if wall else 0:.1f}/s)")
+    print(f"recorded:   {updates[-1][0] - first:.1f}s" if updates else "recorded:   -")
+    print(
+        f"handling:   p50 {percentile(durations, 0.5):.1f} ms  p95 {percentile(durations, 0.95):.1f} ms  "
+        f"p99 {percentile(durations, 0.99):.1f} ms  max {max(durations, default=0):.1f} ms"
+    )
+    for name, n in sorted(calls.items(), key=lambda kv: -kv[1]):
+        print(f"  {name:<28} {n}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Replay recorded bot traffic against local stand-ins.")
+    p.add_argument("files", nargs="+", help="rec-*.ndjson.gz files written by RECORD_DIR")
+    p.add_argument("--db", required=True, help="SQLite file to run against (use a backup copy)")
+    p.add_argument("--speed", type=float, default=1.0, help="time scale; 10 = ten times faster, 0 = no pacing")
+    p.add_argument("--no-latency", action="store_true", help="stand-ins answer immediately")
+    p.add_argument("--callback-key", default="",
+                   help="key the recorded callbacks were signed with (default: CALLBACK_SECRET, else TG_BOT_TOKEN)")
+    args = p.parse_args()
+
+    updates, latency = load(args.files)
+    if not updates:
+        sys.exit("no updates in the given files")
+
+    # domain buttons carry an HMAC keyed with CALLBACK_SECRET or, unset, the production bot
+    # token; the replay runs under a dummy token, so the original key has to be passed on
+    from dotenv import load_dotenv
+    load_dotenv()
+    callback_key = args.callback_key or os.environ.get("CALLBACK_SECRET") or os.environ.get("TG_BOT_TOKEN") or ""
+    if not callback_key and any("callback_query" in d for _, d in updates):
+        sys.exit("the capture has button presses: pass --callback-key (or set CALLBACK_SECRET / TG_BOT_TOKEN) "
+                 "so their signatures verify")
+
+    # the bot reads its configuration at import time (set here so .env cannot override it);
+    # no recording, DNS checks, background jobs or shared state while replaying
+    os.environ.update({
+        "DB_PATH": args.db,
+        "TG_BOT_TOKEN": "1:replay",
+        "CALLBACK_SECRET": callback_key,
+        "CF_API_TOKEN": "replay",
+        "CF_ZONE_ID": os.environ.get("CF_ZONE_ID") or "replay",
+        "CF_BASE_DOMAIN": os.environ.get("CF_BASE_DOMAIN") or "replay.invalid",
+        "RECORD_DIR": "",
+        "NS1": "",
+        "NS2": "",
+        "CF_ZONE_NS": "",
+        "REAPER_INTERVAL": "0",
+        "MAINT_INTERVAL": "0",
+        "STATE_URL": "",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    asyncio.run(replay(bot, updates, latency, args.speed, not args.no_latency))
+
+
+if __name__ == "__main__":
+    main()